@@ -1,3 +1,6 @@
+import marshal
+import os
+import pickle
 from pathlib import Path
 import pytest
 
@@ -79,3 +82,387 @@ def test_get_rows_by_column_filter_works(tmp_path):
     assert rows_for_B == [["B", '2'], ["B", '3']]
     assert rows_for_A == [["A", "1"], ["A", "5"]]
     assert rows_for_C == [["C", "0"]]
+
+
+def test_get_rows_by_column_filter_with_index(tmp_path):
+    # Arrange
+    csvfile = Path(tmp_path) / "file.csv"
+    util.write_rows(csvfile, [
+        ["A", 1],
+        ["B", "multi\nline"],
+        ["B", 3],
+        ["A", 5],
+    ])
+
+    # Act
+    rows_for_B = list(util.get_rows_by_column_filter(csvfile, 0, "B", use_index=True))
+    index_path = Path(str(csvfile) + ".col0.idx")
+    util.append_row(csvfile, ["B", 7])
+    rows_after_append = list(util.get_rows_by_column_filter(csvfile, 0, "B", use_index=True))
+
+    # Assert
+    assert index_path.is_file()
+    assert rows_for_B == [["B", "multi\nline"], ["B", "3"]]
+    assert rows_after_append == rows_for_B + [["B", "7"]]
+    assert list(util.get_rows_by_column_filter(csvfile, 0, "Z", use_index=True)) == []
+
+
+def test_column_index_memory_cache_keeps_most_recent(tmp_path, monkeypatch):
+    # Arrange
+    monkeypatch.setattr(util, "_INDEX_CACHE_SIZE", 2)
+    monkeypatch.setattr(util, "_index_cache", util.OrderedDict())
+    files = [tmp_path / f"file{i}.csv" for i in range(3)]
+    for csvfile in files:
+        util.write_rows(csvfile, [["A", 1], ["B", 2]])
+
+    # Act
+    for csvfile in files[:2] + [files[0]] + files[2:]:
+        list(util.get_rows_by_column_filter(csvfile, 0, "B", use_index=True))
+
+    # Assert
+    assert [key[0] for key in util._index_cache] == [str(files[0]), str(files[2])]
+
+class _RemovesFileWhenUnpickled:
+    def __init__(self, path):
+        self.path = path
+
+    def __reduce__(self):
+        return os.remove, (str(self.path),)
+
+
+def test_column_index_sidecar_is_never_unpickled(tmp_path, monkeypatch):
+    # Arrange - a planted pickle would delete the marker if it were loaded
+    csvfile = tmp_path / "file.csv"
+    marker = tmp_path / "marker"
+    marker.write_text("still here")
+    util.write_rows(csvfile, [["A", 1], ["B", 2]])
+    index_path = Path(str(csvfile) + ".col0.idx")
+    index_path.write_bytes(pickle.dumps(_RemovesFileWhenUnpickled(marker)))
+    monkeypatch.setattr(util, "_index_cache", util.OrderedDict())
+
+    # Act
+    rows = list(util.get_rows_by_column_filter(csvfile, 0, "B", use_index=True))
+
+    # Assert
+    assert rows == [["B", "2"]]
+    assert marker.exists()
+    assert list(marshal.loads(index_path.read_bytes())["offsets"]) == ["A", "B"]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["file.csv", "file.csv.col0.idx", "marker"]
+
+
+def test_get_rows_in_parallel_matches_sequential(tmp_path, monkeypatch):
+    # Arrange - small chunks so quoted newlines land on chunk edges
+    monkeypatch.setattr(util, "_BLOCK_SIZE", 16)
+    csvfile = Path(tmp_path) / "file.csv"
+    rows = [[str(i % 3), f"value\n{i}", "x" * (i % 7)] for i in range(200)]
+    util.write_rows(csvfile, [["Key", "Value", "Pad"]] + rows)
+
+    # Act
+    parallel_rows = list(util.get_rows(csvfile, skip_header=True, workers=2))
+    unordered_rows = list(util.get_rows(csvfile, skip_header=True, workers=2, ordered=False))
+    filtered = list(util.get_rows_by_column_filter(csvfile, 0, "1", workers=2))
+    ranges = util._chunk_ranges(csvfile, 100)
+    first_range = next(ranges)  # available before the rest of the file is scanned
+    ranges = [first_range] + list(ranges)
+
+    # Assert
+    assert ranges[0][0] == 0 and ranges[-1][1] == csvfile.stat().st_size
+    assert all(end == start for (_, end), (start, _) in zip(ranges, ranges[1:]))
+    assert parallel_rows == rows
+    assert sorted(unordered_rows) == sorted(rows)
+    assert filtered == [row for row in rows if row[0] == "1"]
+
+
+def test_get_rows_by_column_filter_with_prefilter(tmp_path):
+    # Arrange - B also shows up inside other fields and in quoted multi-line values
+    csvfile = Path(tmp_path) / "file.csv"
+    util.write_rows(csvfile, [
+        ["A", "B"],
+        ["B", "first\nB, line"],
+        ["BB", "xB"],
+        ["C", "quoted \"B\"\nB"],
+        ["B", 3],
+    ])
+
+    # Act
+    expected = list(util.get_rows_by_column_filter(csvfile, 0, "B"))
+    rows = list(util.get_rows_by_column_filter(csvfile, 0, "B", prefilter=True))
+
+    # Assert
+    assert rows == expected == [["B", "first\nB, line"], ["B", "3"]]
+    assert list(util.get_rows_by_column_filter(csvfile, 1, "xB", prefilter=True)) == [["BB", "xB"]]
+
+
+def test_byte_offset_modes_fall_back_for_utf16(tmp_path):
+    # Arrange
+    csvfile = tmp_path / "wide.csv"
+    util.write_rows(csvfile, [["A", 1], ["B", 2], ["B", 3]], encoding="utf-16")
+    expected = [["B", "2"], ["B", "3"]]
+
+    # Act
+    prefiltered = list(util.get_rows_by_column_filter(csvfile, 0, "B", encoding="utf-16", prefilter=True))
+    indexed = list(util.get_rows_by_column_filter(csvfile, 0, "B", encoding="utf-16", use_index=True))
+    in_parallel = list(util.get_rows_by_column_filter(csvfile, 0, "B", encoding="utf-16", workers=2))
+    all_rows = list(util.get_rows(csvfile, encoding="utf-16", workers=2))
+
+    # Assert
+    assert prefiltered == indexed == in_parallel == expected
+    assert all_rows[1:] == expected
+    with pytest.raises(ValueError, match="ASCII compatible"):
+        util.build_column_index(csvfile, 0, encoding="utf-16")
+
+def test_get_column_batches_infers_types_and_projects(tmp_path):
+    # Arrange
+    csvfile = Path(tmp_path) / "file.csv"
+    util.write_rows(csvfile, [
+        ["Name", "Count", "Price"],
+        ["a", 1, 1],
+        ["b", 2, 2.5],
+        ["c", 3, ""],
+    ])
+
+    # Act
+    batches = list(util.get_column_batches(csvfile, batch_size=2, columns=["Count", "Price"], skip_header=True))
+
+    # Assert
+    assert len(batches) == 2
+    assert batches[0]["Count"].typecode == "q" and list(batches[0]["Count"]) == [1, 2]
+    assert batches[0]["Price"].typecode == "d" and list(batches[0]["Price"]) == [1.0, 2.5]
+    assert batches[1]["Price"][0] != batches[1]["Price"][0]  # nan
+    assert set(batches[0]) == {"Count", "Price"}
+
+
+def test_get_column_batches_widens_ints_beyond_64_bits(tmp_path):
+    # Arrange
+    csvfile = tmp_path / "ids.csv"
+    util.write_rows(csvfile, [["id"], [1], [18446744073709551615]])
+
+    # Act
+    batches = list(util.get_column_batches(csvfile, skip_header=True))
+
+    # Assert
+    assert batches[0]["id"].typecode == "d" and list(batches[0]["id"]) == [1.0, 18446744073709551615.0]
+    with pytest.raises(ValueError, match="not of declared type int"):
+        list(util.get_column_batches(csvfile, skip_header=True, types={"id": int}))
+
+def test_csv_appender_buffers_rows_from_many_threads(tmp_path):
+    # Arrange
+    import threading
+    csvfile = tmp_path / "events.csv"
+    util.write_rows(csvfile, [["event", "n"]])
+
+    def log_events(name):
+        for i in range(250):
+            appender.append_row([name, i])
+
+    # Act
+    with util.CsvAppender(csvfile, max_rows=100, flush_interval=None) as appender:
+        threads = [threading.Thread(target=log_events, args=(f"t{i}",)) for i in range(4)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        appender.append_row(["last", 0])
+        rows_before_close = len(list(util.get_rows(csvfile)))
+
+    # Assert
+    rows = list(util.get_rows(csvfile, skip_header=True))
+    assert rows_before_close == 1001
+    assert len(rows) == 1001 and rows[-1] == ["last", "0"]
+
+
+def test_buffered_append_row_is_written_on_close(tmp_path):
+    csvfile = tmp_path / "events.csv"
+    util.write_rows(csvfile, [["event"]])
+
+    util.append_row(csvfile, ["a"], buffered=True)
+    util.append_rows(csvfile, [["b"], ["c"]], buffered=True)
+    util.close_shared_appenders()
+
+    assert list(util.get_rows(csvfile)) == [["event"], ["a"], ["b"], ["c"]]
+
+
+def test_query_csv_filters_projects_and_limits(tmp_path):
+    # Arrange
+    csvfile = tmp_path / "people.csv"
+    util.write_rows(csvfile, [
+        ["name", "age", "country"],
+        ["ann", 17, "CA"],
+        ["bob", 30, "US"],
+        ["cid", "n/a", "US"],
+        ["dan", 64, "FR"],
+        ["eve", 45, "CA"],
+    ])
+    adults = util.Column("age", int).between(18, 65)
+
+    # Act
+    in_na = list(util.query_csv(csvfile, adults & util.Column("country").isin({"CA", "US"}), columns=["name"]))
+    d_or_young = list(util.query_csv(csvfile, util.Column(0).startswith("d") | ~adults, columns=[0, "country"]))
+    first = list(util.query_csv(csvfile, util.Column("name").matches("^[a-c]"), limit=2))
+
+    # Assert
+    assert in_na == [["bob"], ["eve"]]
+    assert d_or_young == [["ann", "CA"], ["cid", "US"], ["dan", "FR"]]
+    assert first == [["ann", "17", "CA"], ["bob", "30", "US"]]
+
+
+def test_tail_rows_resumes_from_checkpoint(tmp_path):
+    # Arrange
+    csvfile = tmp_path / "growing.csv"
+    util.write_rows(csvfile, [["id"], ["1"], ["2"]])
+
+    # Act
+    first_run = list(util.tail_rows(csvfile, skip_header=True))
+    util.append_rows(csvfile, [["3"], ["4"]])
+    with open(csvfile, "a") as f:
+        f.write("5")  # row still being written
+    second_run = list(util.tail_rows(csvfile, skip_header=True))
+    with open(csvfile, "a") as f:
+        f.write("\n")
+    third_run = list(util.tail_rows(csvfile, skip_header=True))
+    util.write_rows(csvfile, [["id"], ["9"]])  # rotated
+    fourth_run = list(util.tail_rows(csvfile, skip_header=True))
+
+    # Assert
+    assert first_run == [["1"], ["2"]]
+    assert second_run == [["3"], ["4"]]
+    assert third_run == [["5"]]
+    assert fourth_run == [["9"]]
+
+
+def test_sort_csv_spills_and_merges_runs(tmp_path, monkeypatch):
+    # Arrange - a tiny fan-in forces intermediate merges as well
+    monkeypatch.setattr(util, "_MAX_MERGE_FAN_IN", 3)
+    csvfile = tmp_path / "numbers.csv"
+    rows = [[str((i * 7919) % 101), f"row{i}"] for i in range(300)]
+    util.write_rows(csvfile, [["n", "label"]] + rows)
+    outfile = tmp_path / "sorted.csv"
+
+    # Act
+    util.sort_csv(csvfile, ["n"], outfile, numeric=True, header=True, memory_limit=500)
+    sorted_rows = list(util.get_rows(outfile))
+    in_parallel = list(util.sort_csv(csvfile, [0], numeric=True, reverse=True, header=True, memory_limit=500, workers=2))
+    util.sort_csv(csvfile, ["n"], csvfile, numeric=True, header=True, memory_limit=500)
+    in_place = list(util.get_rows(csvfile))
+
+    # Assert
+    assert sorted_rows[0] == ["n", "label"]
+    assert sorted_rows[1:] == sorted(rows, key=lambda row: int(row[0]))
+    assert in_parallel[1:] == sorted(rows, key=lambda row: int(row[0]), reverse=True)
+    assert in_place == sorted_rows
+    assert sorted(tmp_path.iterdir()) == sorted([csvfile, outfile])
+    with pytest.raises(ValueError, match="use header=True"):
+        list(util.sort_csv(csvfile, ["n"]))
+
+
+def test_group_by_csv_aggregates_per_key(tmp_path):
+    # Arrange
+    csvfile = tmp_path / "orders.csv"
+    util.write_rows(csvfile, [
+        ["customer", "amount"],
+        ["b", 10],
+        ["a", 1],
+        ["b", 2.5],
+        ["a", 3],
+    ])
+
+    # Act
+    groups = list(util.group_by_csv(csvfile, ["customer"], [("amount", "count"), ("amount", "sum"), ("amount", "max")], header=True, memory_limit=100))
+    others = list(util.group_by_csv(csvfile, [0], [(1, "mean"), (1, "min"), (1, "first"), (1, "last")], header=True))
+
+    # Assert
+    assert groups == [
+        ["customer", "count_amount", "sum_amount", "max_amount"],
+        ["a", 2, 4, 3],
+        ["b", 2, 12.5, 10],
+    ]
+    assert others[1:] == [["a", 2, 1, "1", "3"], ["b", 6.25, 2.5, "10", "2.5"]]
+
+
+def test_sort_csv_numeric_puts_empty_cells_first(tmp_path):
+    # Arrange
+    csvfile = tmp_path / "scores.csv"
+    util.write_rows(csvfile, [["10"], [""], ["-2"], ["3.5"]])
+
+    # Act
+    ascending = list(util.sort_csv(csvfile, [0], numeric=True))
+    util.write_rows(csvfile, [["1"], ["abc"]])
+
+    # Assert
+    assert ascending == [[""], ["-2"], ["3.5"], ["10"]]
+    with pytest.raises(ValueError, match="cannot sort 'abc' numerically"):
+        list(util.sort_csv(csvfile, [0], numeric=True))
+
+
+def test_get_rows_cache_is_used_until_file_changes(tmp_path):
+    # Arrange
+    csvfile = tmp_path / "reference.csv"
+    cache_dir = tmp_path / "cache"
+    util.write_rows(csvfile, [["code", "name"], ["1", "one"], ["2", "two"]])
+
+    # Act
+    first = list(util.get_rows(csvfile, skip_header=True, cache_dir=cache_dir))
+    cache_files = list(cache_dir.glob("*.rows"))
+    from_cache = list(util.get_rows(csvfile, skip_header=True, cache_dir=cache_dir))
+    util.append_row(csvfile, ["3", "three"])
+    after_change = list(util.get_rows(csvfile, skip_header=True, cache_dir=cache_dir, cache_max_bytes=0))
+
+    # Assert
+    assert len(cache_files) == 1
+    assert first == from_cache == [["1", "one"], ["2", "two"]]
+    assert after_change == first + [["3", "three"]]
+    assert list(cache_dir.glob("*.rows")) == []  # trimmed to cache_max_bytes
+
+
+def test_join_csv_inner_left_anti_and_grace(tmp_path):
+    # Arrange
+    orders = tmp_path / "orders.csv"
+    customers = tmp_path / "customers.csv"
+    util.write_rows(orders, [["order", "customer"], ["o1", "c1"], ["o2", "c3"], ["o3", "c2"], ["o4", "c1"]])
+    util.write_rows(customers, [["id", "name"], ["c1", "ann"], ["c2", "bob"]])
+
+    # Act
+    inner = list(util.join_csv(orders, customers, "customer", "id", header=True))
+    left = list(util.join_csv(orders, customers, 1, 0, how="left", header=True))
+    anti = list(util.join_csv(orders, customers, "customer", "id", how="anti", header=True))
+    grace = list(util.join_csv(orders, customers, "customer", "id", how="left", header=True, memory_limit=1))
+    util.join_csv(orders, customers, "customer", "id", how="left", out_path=orders, header=True)
+
+    # Assert
+    assert inner == [
+        ["order", "customer", "id", "name"],
+        ["o1", "c1", "c1", "ann"],
+        ["o3", "c2", "c2", "bob"],
+        ["o4", "c1", "c1", "ann"],
+    ]
+    assert left[2] == ["o2", "c3", "", ""] and len(left) == 5
+    assert anti == [["order", "customer"], ["o2", "c3"]]
+    assert grace[0] == left[0] and sorted(grace[1:]) == sorted(left[1:])
+    assert list(util.get_rows(orders)) == left
+
+
+def test_append_to_compressed_file_with_plain_name_stays_compressed(tmp_path):
+    # Arrange
+    csvfile = tmp_path / "archived.csv"
+    util.write_rows(tmp_path / "rows.csv.gz", [["1", "a"], ["2", "b"]])
+    (tmp_path / "rows.csv.gz").rename(csvfile)
+
+    # Act
+    util.append_row(csvfile, ["3", "c"])
+
+    # Assert
+    assert list(util.get_rows(csvfile)) == [["1", "a"], ["2", "b"], ["3", "c"]]
+
+@pytest.mark.parametrize("name", ["rows.csv.gz", "rows.csv.bz2", "rows.csv.xz"])
+def test_compressed_csv_is_written_appended_and_read(tmp_path, name):
+    # Arrange
+    csvfile = tmp_path / name
+
+    # Act
+    util.write_rows(csvfile, [["a", "b"], ["1", "multi\nline"]], compresslevel=1)
+    util.append_rows(csvfile, [["2", "x"]])
+    util.append_row(csvfile, ["3", "y"])
+    renamed = csvfile.rename(tmp_path / "no_extension")  # detected by magic bytes
+
+    # Assert
+    expected = [["1", "multi\nline"], ["2", "x"], ["3", "y"]]
+    assert list(util.get_rows(renamed, skip_header=True)) == expected
+    assert list(util.get_rows_by_column_filter(renamed, 0, "2", prefilter=True)) == [["2", "x"]]
@@ -1,3 +1,5 @@
+import datetime
+import marshal
 import os
 import pytest
 import zipfile
@@ -146,3 +148,396 @@ def test_create_dir_if_not_exists_works(tmpdir):
 
     # assert
     assert test_dirs.is_dir()
+
+
+def test_zipdir_in_parallel_creates_standard_zip(tmp_path):
+    # Arrange
+    source_dir = tmp_path / "mydir"
+    (source_dir / "sub").mkdir(parents=True)
+    contents = {f"file{i}.txt": (f"line {i}\n" * 5000 * i).encode() for i in range(6)}
+    for name, data in contents.items():
+        (source_dir / name).write_bytes(data)
+    (source_dir / "sub" / "image.png").write_bytes(os.urandom(1000))
+
+    # Act
+    zip_path = util.zipdir(source_dir, tmp_path / "out.zip", workers=3, compresslevel=1)
+
+    # Assert
+    with zipfile.ZipFile(zip_path) as z:
+        assert z.testzip() is None
+        for name, data in contents.items():
+            assert z.read(f"mydir/{name}") == data
+            assert z.getinfo(f"mydir/{name}").compress_type == zipfile.ZIP_DEFLATED
+        assert z.getinfo("mydir/sub/image.png").compress_type == zipfile.ZIP_STORED
+        assert "mydir/sub/" in z.namelist()
+
+
+def test_zipfiles_stores_directories_and_resolves_conflicts(tmp_path):
+    # Arrange
+    first, second = tmp_path / "first", tmp_path / "second"
+    (first / "docs").mkdir(parents=True)
+    second.mkdir()
+    (first / "docs" / "readme.txt").write_text("from first")
+    (first / "a.txt").write_text("first a")
+    (second / "a.txt").write_text("second a")
+    zip_path = tmp_path / "files_archive.zip"
+
+    # Act
+    util.zipfiles(zip_path, [first / "docs", first / "a.txt", second / "a.txt"], workers=2)
+    with pytest.raises(FileExistsError):
+        util.zipfiles(tmp_path / "other.zip", [first / "a.txt", second / "a.txt"], on_conflict="error")
+    util.zipfiles(tmp_path / "first.zip", [first / "a.txt", second / "a.txt"], on_conflict="first")
+
+    # Assert
+    with zipfile.ZipFile(zip_path) as z:
+        assert sorted(z.namelist()) == ["a.txt", "docs/", "docs/readme.txt"]
+        assert z.read("a.txt") == b"second a"
+    with zipfile.ZipFile(tmp_path / "first.zip") as z:
+        assert z.read("a.txt") == b"first a"
+
+
+def test_zipdir_incremental_only_recompresses_changes(tmp_path):
+    # Arrange
+    source_dir = tmp_path / "mydir"
+    source_dir.mkdir()
+    (source_dir / "same.txt").write_text("unchanged " * 1000)
+    (source_dir / "edit.txt").write_text("old")
+    (source_dir / "gone.txt").write_text("deleted")
+    os.utime(source_dir / "same.txt", (1600000001, 1600000001))  # odd seconds
+    zip_path = util.zipdir(source_dir, compresslevel=9)
+    same_size = zipfile.ZipFile(zip_path).getinfo("mydir/same.txt").compress_size
+
+    (source_dir / "edit.txt").write_text("new content")
+    (source_dir / "gone.txt").unlink()
+    (source_dir / "added.txt").write_text("added " * 1000)
+
+    # Act - level 0 shows which members were compressed again
+    with patch("utilfuncs.file._crc32_of", wraps=util.file._crc32_of) as crc32_of:
+        util.zipdir(source_dir, zip_path, compresslevel=0, incremental=True)
+
+    # Assert
+    with zipfile.ZipFile(zip_path) as z:
+        assert z.testzip() is None
+        assert sorted(z.namelist()) == ["mydir/added.txt", "mydir/edit.txt", "mydir/same.txt"]
+        assert z.read("mydir/edit.txt") == b"new content"
+        assert z.getinfo("mydir/same.txt").compress_size == same_size
+        assert z.getinfo("mydir/added.txt").compress_size >= 6000
+    crc32_of.assert_not_called()
+    assert not Path(str(zip_path) + ".tmp").exists()
+
+
+def test_unzip_extracts_filters_and_skips_unchanged(tmp_path):
+    # Arrange
+    zip_path = tmp_path / "logs.zip"
+    with zipfile.ZipFile(zip_path, "w") as z:
+        z.writestr("logs/a_error_.log", "boom")
+        z.writestr("logs/b.log", "fine")
+        z.writestr("readme.txt", "hello")
+    dest = tmp_path / "out"
+
+    # Act
+    errors_only = util.unzip(zip_path, dest, pattern="*_error_*", workers=2)
+    everything = util.unzip(zip_path, dest, workers=2)
+
+    # Assert
+    assert errors_only == [(dest / "logs" / "a_error_.log").resolve()]
+    assert sorted(p.name for p in everything) == ["b.log", "readme.txt"]
+    assert (dest / "readme.txt").read_text() == "hello"
+
+
+def test_unzip_rejects_zip_slip(tmp_path):
+    zip_path = tmp_path / "evil.zip"
+    with zipfile.ZipFile(zip_path, "w") as z:
+        z.writestr("ok.txt", "fine")
+        z.writestr("../evil.txt", "gotcha")
+
+    with pytest.raises(util.UnsafeArchiveMember):
+        util.unzip(zip_path, tmp_path / "out")
+
+    assert not (tmp_path / "evil.txt").exists()
+    assert not (tmp_path / "out" / "ok.txt").exists()
+
+
+def test_base64_streaming_round_trip(tmp_path):
+    # Arrange
+    import io
+    src = tmp_path / "blob.bin"
+    src.write_bytes(os.urandom(10000))
+    encoded_path = tmp_path / "blob.b64"
+    decoded = io.BytesIO()
+
+    # Act
+    chunks = list(util.iter_base64_encoded_chunks(src, chunk_size=999))
+    util.write_base64_encoded(src, encoded_path, chunk_size=300)
+    util.write_base64_decoded(encoded_path, decoded, chunk_size=77)
+
+    # Assert
+    assert b"".join(chunks).decode("utf-8") == util.get_base64_encoded_contents(src)
+    assert encoded_path.read_bytes() == b"".join(chunks)
+    assert decoded.getvalue() == src.read_bytes()
+    with pytest.raises(ValueError):
+        next(util.iter_base64_encoded_chunks(src, chunk_size=1000))
+
+
+def test_detect_encoding_sniffs_bom_utf8_and_caches(tmp_path, monkeypatch):
+    # Arrange
+    monkeypatch.setattr(util.file, "_ENCODING_CACHE_SIZE", 1)
+    monkeypatch.setattr(util.file, "_encoding_cache", util.file.OrderedDict())
+    bom_file = tmp_path / "bom.txt"
+    bom_file.write_bytes("héllo".encode("utf-16"))
+    utf8_file = tmp_path / "utf8.txt"
+    utf8_file.write_bytes("naïve café".encode("utf-8"))
+
+    # Act
+    with patch("utilfuncs.file.UniversalDetector") as detector:
+        encodings = [util.detect_encoding(bom_file), util.detect_encoding(utf8_file)]
+
+    # Assert
+    assert encodings == ["utf-16", "utf-8"]
+    detector.assert_not_called()
+    assert [key[0] for key in util.file._encoding_cache] == [os.path.abspath(utf8_file)]
+    assert util.get_contents_as_utf8(utf8_file) == utf8_file.read_bytes()
+
+
+def test_transcode_to_utf8_streams_to_destination(tmp_path):
+    # Arrange
+    src = tmp_path / "latin.txt"
+    text = "Ceci est un texte en français, très ordinaire. " * 200
+    src.write_bytes(text.encode("utf-16"))
+    dest = tmp_path / "out.txt"
+
+    # Act
+    util.transcode_to_utf8(src, dest, chunk_size=1001)
+
+    # Assert
+    assert dest.read_bytes() == text.encode("utf-8")
+
+
+def test_transcode_dir_to_utf8_reports_per_file(tmp_path):
+    # Arrange
+    src = tmp_path / "vendor"
+    src.mkdir()
+    (src / "a.csv").write_bytes("ünïcode".encode("utf-16"))
+    (src / "b.csv").write_bytes("plain".encode("utf-8"))
+    dest = tmp_path / "normalized"
+
+    # Act
+    report = util.transcode_dir_to_utf8(src, ".csv", dest_dir=dest, workers=2)
+
+    # Assert
+    statuses = {r["path"].name: r["status"] for r in report["files"]}
+    assert statuses == {"a.csv": "transcoded", "b.csv": "copied"}
+    assert report["transcoded"] == 1 and report["copied"] == 1 and report["failed"] == 0
+    assert (dest / "a.csv").read_text(encoding="utf-8") == "ünïcode"
+    assert (dest / "b.csv").read_text(encoding="utf-8") == "plain"
+
+
+def test_transcode_dir_to_utf8_leaves_undetectable_files_untouched(tmp_path):
+    # Arrange
+    src = tmp_path / "mixed"
+    src.mkdir()
+    blob = bytes(range(256)) * 16
+    (src / "blob.bin").write_bytes(blob)
+
+    # Act
+    report = util.transcode_dir_to_utf8(src)
+
+    # Assert
+    assert report["failed"] == 1 and report["transcoded"] == 0
+    assert (src / "blob.bin").read_bytes() == blob
+    with pytest.raises(util.UndetectedEncoding):
+        util.transcode_to_utf8(src / "blob.bin")
+
+
+def test_iter_files_walks_recursively_with_filters(tmp_path):
+    # Arrange
+    (tmp_path / "a" / "b").mkdir(parents=True)
+    (tmp_path / "top.log").write_text("x" * 10)
+    (tmp_path / "top.log.bak").write_text("x")
+    (tmp_path / "a" / "mid.log").write_text("x" * 100)
+    (tmp_path / "a" / "b" / "deep.log").write_text("x")
+    old = tmp_path / "a" / "old.log"
+    old.write_text("x")
+    os.utime(old, (0, 0))
+
+    def names(**kwargs):
+        return sorted(entry.name for entry in util.iter_files(tmp_path, ".log", **kwargs))
+
+    # Act / Assert
+    assert names() == ["deep.log", "mid.log", "old.log", "top.log"]
+    assert names(max_depth=1) == ["mid.log", "old.log", "top.log"]
+    assert names(min_size=10) == ["mid.log", "top.log"]
+    assert names(modified_before=1000.0) == ["old.log"]
+    assert names(pattern="*p.*", workers=3) == ["deep.log", "top.log"]
+    assert [p.name for p in util.all_files_under(tmp_path, ".log")] == ["top.log"]
+
+
+def test_delete_old_files_only_deletes_old_files(tmp_path):
+    old = tmp_path / "old.log"
+    new = tmp_path / "new.log"
+    old.write_text("_")
+    new.write_text("_")
+    os.utime(old, (0, 0))
+
+    deleted = util.delete_old_files(tmp_path, 1, ".log")
+
+    assert deleted == [old]
+    assert new.is_file() and not old.exists()
+
+
+def test_apply_retention_plans_archives_and_deletes(tmp_path):
+    # Arrange - five 100 byte logs, one per day, the oldest in a subdir
+    logs = tmp_path / "logs"
+    (logs / "old").mkdir(parents=True)
+    now = datetime.datetime.now().timestamp()
+    paths = [logs / f"day{i}.log" for i in range(4)] + [logs / "old" / "day4.log"]
+    for i, path in enumerate(paths):
+        path.write_bytes(b"x" * 100)
+        os.utime(path, (now - i * 86400 - 60, now - i * 86400 - 60))
+    archive = tmp_path / "expired.zip"
+
+    # Act
+    plan = util.apply_retention(logs, max_age_days=3.5, max_total_bytes=250, dry_run=True)
+    exist_after_dry_run = all(p.exists() for p in paths)
+    report = util.apply_retention(logs, keep_newest=3, workers=2, archive_path=archive)
+
+    # Assert
+    assert sorted(p.name for p in plan["planned"]) == ["day2.log", "day3.log", "day4.log"]
+    assert exist_after_dry_run
+    assert sorted(p.name for p in report["deleted"]) == ["day3.log", "day4.log"]
+    assert report["bytes_freed"] == 200 and report["kept"] == 3
+    with zipfile.ZipFile(archive) as z:
+        assert sorted(z.namelist()) == ["day3.log", "old/day4.log"]
+
+
+def test_apply_retention_appends_to_archive_and_stops_at_size_cap(tmp_path):
+    # Arrange - archive inside the scanned dir, sizes newest to oldest 5/100/3
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    now = datetime.datetime.now().timestamp()
+    for i, (name, size) in enumerate([("new.log", 5), ("mid.log", 100), ("oldest.log", 3)]):
+        (logs / name).write_bytes(b"x" * size)
+        os.utime(logs / name, (now - i * 60, now - i * 60))
+    archive = logs / "expired.zip"
+
+    # Act
+    first = util.apply_retention(logs, max_total_bytes=10, archive_path=archive)
+    second = util.apply_retention(logs, keep_newest=0, archive_path=archive)
+
+    # Assert
+    assert sorted(p.name for p in first["planned"]) == ["mid.log", "oldest.log"]
+    assert [p.name for p in second["planned"]] == ["new.log"]
+    assert os.listdir(logs) == ["expired.zip"]
+    with zipfile.ZipFile(archive) as z:
+        assert sorted(z.namelist()) == ["mid.log", "new.log", "oldest.log"]
+
+
+def test_bulk_move_files_renames_and_copies_across_devices(tmp_path, monkeypatch):
+    # Arrange
+    src = tmp_path / "src"
+    src.mkdir()
+    dest = create_dest(tmp_path)
+    build_dummy_files(src, ["a.txt", "b.txt", "c.log", "d_error_.log", "e.log"])
+    (dest / "a.txt").write_text("old")
+    real_stat = os.stat
+
+    def stat_dest_on_other_device(path, *args, **kwargs):
+        result = real_stat(path, *args, **kwargs)
+        if Path(path) != dest:
+            return result
+        return os.stat_result(tuple(result[:2]) + (result.st_dev + 1,) + tuple(result[3:10]))
+
+    # Act
+    summary = util.bulk_move_files(src, dest, ".txt")
+    monkeypatch.setattr(os, "stat", stat_dest_on_other_device)
+    cross = util.bulk_move_files(src, dest, pattern="*_error_*", workers=2)
+
+    # Assert
+    assert summary["moved"] == 2 and summary["renamed"] == 2 and summary["failed"] == []
+    assert (dest / "a.txt").read_text() == "_" and not (src / "a.txt").exists()
+    assert cross["copied"] == 1 and cross["bytes"] == 1 and cross["failed"] == []
+    assert (dest / "d_error_.log").read_text() == "_" and not (src / "d_error_.log").exists()
+    assert (src / "c.log").is_file() and (src / "e.log").is_file()
+
+
+def test_fingerprint_tree_uses_cache_and_finds_duplicates(tmp_path):
+    # Arrange
+    tree = tmp_path / "tree"
+    (tree / "sub").mkdir(parents=True)
+    big = os.urandom(200 * 1024)
+    (tree / "big1.bin").write_bytes(big)
+    (tree / "sub" / "big2.bin").write_bytes(big)
+    (tree / "big3.bin").write_bytes(big[:-1] + bytes([big[-1] ^ 1]))  # same size and head
+    (tree / "small1.txt").write_text("same")
+    (tree / "sub" / "small2.txt").write_text("same")
+    (tree / "other.txt").write_text("diff")
+    cache = tmp_path / "fingerprints.cache"
+
+    # Act
+    fingerprints = util.fingerprint_tree(tree, workers=2, cache_path=cache)
+    with patch("utilfuncs.file._hash_file") as hash_file:
+        cached = util.fingerprint_tree(tree, cache_path=cache)
+    duplicates = util.find_duplicate_files(tree, workers=2)
+    for _ in range(3):
+        (tree / "other.txt").write_text("diff" * (len((tree / "other.txt").read_text()) + 1))
+        util.fingerprint_tree(tree, cache_path=cache)
+    with open(cache, "rb") as f:
+        cached_entries = marshal.load(f)["entries"]
+
+    # Assert
+    assert len(fingerprints) == 6 and cached == fingerprints
+    hash_file.assert_not_called()
+    assert len(cached_entries) == 6  # edits replace the file's old entry
+    assert duplicates == [
+        [tree / "big1.bin", tree / "sub" / "big2.bin"],
+        [tree / "small1.txt", tree / "sub" / "small2.txt"],
+    ]
+
+
+def test_fingerprint_tree_ignores_foreign_cache_files(tmp_path):
+    # Arrange
+    tree = tmp_path / "tree"
+    tree.mkdir()
+    (tree / "a.txt").write_text("a")
+    cache = tmp_path / "fingerprints.cache"
+    cache.write_bytes(b"\x80\x04not a marshal file")
+
+    # Act
+    fingerprints = util.fingerprint_tree(tree, cache_path=cache)
+
+    # Assert
+    assert list(fingerprints.values()) == [util.file.hashlib.sha256(b"a").hexdigest()]
+    with open(cache, "rb") as f:
+        assert list(marshal.load(f)["entries"].values()) == list(fingerprints.values())
+
+def test_snapshot_diff_reports_added_removed_and_modified(tmp_path):
+    # Arrange
+    tree = tmp_path / "tree"
+    (tree / "sub").mkdir(parents=True)
+    (tree / "keep.txt").write_text("keep")
+    (tree / "sub" / "edit.txt").write_text("before")
+    (tree / "gone.txt").write_text("gone")
+    (tree / "touched.txt").write_text("touched")
+    snapshot_file = util.take_snapshot(tree, fingerprints=True).save(tmp_path / "tree.snapshot")
+
+    (tree / "sub" / "edit.txt").write_text("after!")
+    (tree / "gone.txt").unlink()
+    (tree / "new.txt").write_text("new")
+    os.utime(tree / "touched.txt", (0, 0))
+
+    # Act
+    old = util.DirSnapshot.load(snapshot_file)
+    by_content = util.diff_snapshots(old, util.take_snapshot(tree, fingerprints=True))
+    by_stat = util.diff_snapshots(old, util.take_snapshot(tree))
+
+    # Assert
+    assert len(old) == 4
+    assert by_content == {
+        "added": [tree / "new.txt"],
+        "removed": [tree / "gone.txt"],
+        "modified": [tree / "sub" / "edit.txt"],
+    }
+    assert by_stat["modified"] == [tree / "sub" / "edit.txt", tree / "touched.txt"]
+    (tmp_path / "bogus.snapshot").write_bytes(b"\x80\x04bogus")
+    with pytest.raises(ValueError, match="not a directory snapshot"):
+        util.DirSnapshot.load(tmp_path / "bogus.snapshot")
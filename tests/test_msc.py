@@ -1,5 +1,9 @@
+import asyncio
+import re
 from unittest.mock import patch
 
+import pytest
+
 import utilfuncs as util
 
 
@@ -25,6 +29,66 @@ def test_keep_trying_works_on_expected_error(mock_sleep):
     mock_sleep.assert_called_with(2)
 
 
+@patch("time.sleep")
+def test_retry_policy_backs_off_and_stops_after_max_attempts(mock_sleep):
+    # arrange
+    calls = []
+
+    @util.RetryPolicy(exceptions=OSError, match=["busy", re.compile(r"code 5\d\d")], max_attempts=4, initial_delay=1, jitter=0)
+    def flaky(errors):
+        calls.append(1)
+        raise errors[len(calls) - 1]
+
+    policy = util.RetryPolicy(initial_delay=0.5, backoff=3, max_delay=2, jitter=0)
+    results = iter([ValueError("x"), ValueError("x"), ValueError("x"), "done"])
+
+    def recover():
+        item = next(results)
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    # act
+    result, stats = policy.call_with_stats(recover)
+    with pytest.raises(OSError, match="Busy"):
+        flaky([OSError("code 503"), OSError("Busy"), OSError("Busy"), OSError("Busy"), OSError("never")])
+    flaky_calls = len(calls)
+    calls.clear()
+    with pytest.raises(KeyError):
+        flaky([KeyError("busy")])
+
+    # assert
+    assert result == "done"
+    assert stats["attempts"] == 4 and stats["slept"] == 0.5 + 1.5 + 2
+    assert [c.args[0] for c in mock_sleep.call_args_list] == [0.5, 1.5, 2, 1, 2, 4]
+    assert flaky_calls == 4 and len(calls) == 1
+
+
+def test_retry_policy_async_uses_asyncio_sleep():
+    # arrange
+    attempts = []
+    sleeps = []
+
+    async def fake_sleep(delay):
+        sleeps.append(delay)
+
+    @util.RetryPolicy(match="try again", initial_delay=1, jitter=0.5)
+    async def connect():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ConnectionError("Try again later")
+        return "connected"
+
+    # act
+    with patch("asyncio.sleep", fake_sleep):
+        result = asyncio.run(connect())
+
+    # assert
+    assert result == "connected"
+    assert len(sleeps) == 2
+    assert 0.5 <= sleeps[0] <= 1 and 1 <= sleeps[1] <= 2
+
+
 def test_filter_by_glob_works():
     my_list = ["hulk_smash.txt", "hulk_smash.log", "hulk_sleep.txt"]
 
@@ -46,4 +110,16 @@ def test_filter_by_glob_works_v1():
 
     result = util.filter_by_glob(my_list, pattern)
 
-    assert expected == result
\ No newline at end of file
+    assert expected == result
+
+
+def test_filter_by_glob_handles_any_wildcards_and_many_patterns():
+    my_list = ["report_2024_01.csv", "report_final.csv", "report.csv", "notes.TXT", "data1.bin", "data12.bin", "aba"]
+
+    assert util.filter_by_glob(my_list, "report.csv") == ["report.csv"]
+    assert util.filter_by_glob(my_list, "report_*_*.csv") == ["report_2024_01.csv"]
+    assert util.filter_by_glob(my_list, "data?.bin") == ["data1.bin"]
+    assert util.filter_by_glob(my_list, "data[0-9][0-9].bin") == ["data12.bin"]
+    assert util.filter_by_glob(my_list, "ab*ba") == []
+    assert util.filter_by_glob(my_list, ["*.txt", "report_f*", "aba"], ignorecase=True) == ["report_final.csv", "notes.TXT", "aba"]
+    assert util.GlobMatcher(["*.bin", "x"]).filter(range(3)) == []
@@ -7,5 +7,11 @@ class Error(Exception):
 class InvalidDirectoryPath(Error):
     """The path specified was not a valid directory"""
 
+class UnsafeArchiveMember(Error):
+    """An archive member would be extracted outside of the destination directory"""
+
+class UndetectedEncoding(Error):
+    """The text encoding of a file could not be detected, it may be binary"""
+
 
 PathLike = Union[pathlib.Path, str]
@@ -2,10 +2,57 @@
 Utility csv functions for reading/writing/appending data.
 """
 import csv as pycsv
-from typing import Any, Generator, List
+import atexit
+import bz2
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import lzma
+import marshal
+import mmap
+import os
+import operator
+import pickle
+import re
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import chain, groupby, islice
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Callable, Dict, Generator, Iterable, List, Optional, Sequence, Tuple, Union
 from utilfuncs.common import *
 
-def get_rows(csvpath: PathLike, skip_header=False, delimiter=",", encoding="utf-8") -> Generator[List[str], None, None]:
+_QUOTE = b'"'
+_COMPRESSION_SUFFIXES = {".gz": "gzip", ".bz2": "bz2", ".xz": "lzma", ".lzma": "lzma"}
+_COMPRESSION_MAGIC = ((b"\x1f\x8b", "gzip"), (b"BZh", "bz2"), (b"\xfd7zXZ\x00", "lzma"))
+_READ_BUFFER_SIZE = 1024 * 1024
+_INDEX_VERSION = 2
+_INDEX_CACHE_SIZE = 16
+_index_cache = OrderedDict()
+_index_cache_lock = threading.Lock()
+_PARALLEL_CHUNK_SIZE = 64 * 1024 * 1024
+_BLOCK_SIZE = 1024 * 1024
+_WIDENING = [int, float, str]
+_CHECKPOINT_HEAD_SIZE = 64
+_SORT_MEMORY_LIMIT = 256 * 1024 * 1024
+_MAX_MERGE_FAN_IN = 64
+_RUN_BATCH_ROWS = 4096
+_AGGREGATIONS = ("count", "sum", "mean", "min", "max", "first", "last")
+_JOIN_TYPES = ("inner", "left", "anti")
+_MAX_JOIN_PARTITIONS = 256
+_ROW_CACHE_VERSION = 1
+_ROW_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+_ROW_CACHE_BATCH_ROWS = 8192
+_shared_appenders = {}
+_shared_appenders_lock = threading.Lock()
+
+def get_rows(csvpath: PathLike, skip_header=False, delimiter=",", encoding="utf-8", workers: int = None, ordered=True, cache_dir: PathLike = None, cache_max_bytes=_ROW_CACHE_MAX_BYTES) -> Generator[List[str], None, None]:
     """
     get_rows yields rows from the csv file specified.
     The caller must iterate over the returned generator
@@ -16,11 +63,35 @@ def get_rows(csvpath: PathLike, skip_header=False, delimiter=",", encoding="utf-
         skip_header: Whether to skip header row, default False
         delimiter: Row delimiter character, default ","
         encoding: File encoding, default "utf-8"
+        workers (int, optional): Number of processes to parse the file with.
+            The file is split into byte ranges on row boundaries (quoted newlines
+            included) which are parsed in a process pool. Other than ASCII
+            compatible encodings (utf-16...) are read in this process.
+            Defaults to None, parsing in this process.
+        ordered (bool, optional): With workers, whether rows come back in file
+            order or as soon as their range is parsed. Defaults to True.
+        cache_dir (optional): Directory of a binary cache of parsed files. Rows are
+            served from it while the file's size and mtime are unchanged, and it
+            is filled on the first full read. Defaults to None, no caching.
+        cache_max_bytes (int, optional): Size the cache directory is trimmed to,
+            least recently used entries first. Defaults to 1 GB.
+
+    Gzip, bz2 and xz compressed files are detected by their magic bytes or
+    extension and decompressed on the fly. They are always read in this
+    process, workers is ignored for them.
 
     Yields:
         List of strings representing rows
     """
-    with open(csvpath, "r", encoding=encoding) as csvfile:
+    if workers is not None and workers > 1 and _compression_of(csvpath) is None and _is_ascii_compatible(encoding, delimiter):
+        yield from _get_rows_parallel(csvpath, skip_header, delimiter, encoding, workers, ordered)
+        return
+
+    if cache_dir is not None:
+        yield from _get_rows_cached(csvpath, skip_header, delimiter, encoding, cache_dir, cache_max_bytes)
+        return
+
+    with _open_csv(csvpath, "r", encoding=encoding) as csvfile:
         reader = pycsv.reader(csvfile, delimiter=delimiter)
         for row in reader:
             if skip_header:
@@ -29,55 +100,225 @@ def get_rows(csvpath: PathLike, skip_header=False, delimiter=",", encoding="utf-
             yield row
 
 
-def write_rows(csvpath: PathLike, list_of_rows: List[List[str]], delimiter=",", encoding="utf-8") -> None:
+def write_rows(csvpath: PathLike, list_of_rows: List[List[str]], delimiter=",", encoding="utf-8", compresslevel: int = None) -> None:
     """
     Write rows to csv file.
+    Paths ending in .gz, .bz2 or .xz are written compressed.
 
     Args:
         csvpath: Path to csv file
         list_of_rows: 2D list of strings
         delimiter: Row delimiter character, default ","
         encoding: File encoding, default "utf-8"
+        compresslevel (int, optional): Compression level (preset for xz) of
+            compressed files. Defaults to the compressor's default.
     """
-    with open(csvpath, "w", newline="", encoding=encoding) as csvfile:
+    with _open_csv(csvpath, "w", encoding=encoding, newline="", compresslevel=compresslevel) as csvfile:
         writer = pycsv.writer(csvfile, delimiter=delimiter)
         writer.writerows(list_of_rows)
 
 
-def append_row(csvpath: PathLike, row: List[str], delimiter=",", encoding="utf-8") -> None:
+def append_row(csvpath: PathLike, row: List[str], delimiter=",", encoding="utf-8", buffered=False, compresslevel: int = None) -> None:
     """
     Appends a single row to the csv file specified.
-    The file must already exist.
+    The file must already exist. Compressed files get a new compressed stream
+    appended, which their readers handle transparently.
 
     Args:
         csvpath: path to csv file
         row: A list of strings
         delimiter: Row delimiter, defaults to ","
         encoding: File encoding, defaults to "utf-8"
+        buffered (bool, optional): Route the row through a shared CsvAppender kept
+            open for this path instead of opening the file. The row is written on
+            the appender's next flush, see close_shared_appenders. Defaults to False.
+        compresslevel (int, optional): Compression level of compressed files.
     """
-    with open(csvpath, "a", newline="", encoding=encoding) as csvfile:
+    if buffered:
+        _get_shared_appender(csvpath, delimiter, encoding).append_row(row)
+        return
+
+    with _open_csv(csvpath, "a", encoding=encoding, newline="", compresslevel=compresslevel) as csvfile:
         writer = pycsv.writer(csvfile, delimiter=delimiter)
         writer.writerow(row)
 
 
-def append_rows(csvpath: PathLike, list_of_rows: List[List[str]], delimiter=",", encoding="utf-8"):
+def append_rows(csvpath: PathLike, list_of_rows: List[List[str]], delimiter=",", encoding="utf-8", buffered=False, compresslevel: int = None):
     """
     Appends multiple rows to the csv file specified.
-    The file must already exist.
+    The file must already exist. See append_row for compressed files.
 
     Args:
         csvpath: path to csv file
         list_of_rows: 2D list of strings
         delimiter: Row delimiter, defaults to ","
         encoding: File encoding, defaults to "utf-8"
+        buffered (bool, optional): Route the rows through a shared CsvAppender, see
+            append_row. Defaults to False.
+        compresslevel (int, optional): Compression level of compressed files.
     """
-    with open(csvpath, "a", newline="", encoding=encoding) as csvfile:
+    if buffered:
+        _get_shared_appender(csvpath, delimiter, encoding).append_rows(list_of_rows)
+        return
+
+    with _open_csv(csvpath, "a", encoding=encoding, newline="", compresslevel=compresslevel) as csvfile:
         writer = pycsv.writer(csvfile, delimiter=delimiter)
         for row in list_of_rows:
             writer.writerow(row)
 
 
-def get_rows_by_column_filter(filepath: PathLike, col_index: int, col_value: Any, delimiter=",", encoding="utf-8") -> Generator[List[str], None, None]:
+class CsvAppender:
+    """
+    Keeps a csv file open for appending and buffers rows in memory, writing
+    them out in one call once enough rows, characters or time have accumulated.
+    Safe to share between threads.
+
+    Example:
+        Logging events::
+
+            >>> with CsvAppender("events.csv", max_rows=500) as appender:
+            ...     appender.append_row(["login", "alice"])
+
+    Args:
+        csvpath: path to csv file
+        delimiter: Row delimiter, defaults to ","
+        encoding: File encoding, defaults to "utf-8"
+        max_rows (int, optional): Flush once this many rows are buffered. Defaults to 1000.
+        max_bytes (int, optional): Flush once the buffered text reaches this many
+            characters. Defaults to 1 MB.
+        flush_interval (float, optional): Seconds after which buffered rows are
+            flushed by a background thread. None disables it. Defaults to 1.0.
+        fsync (bool, optional): Whether to fsync the file on every flush. Defaults to False.
+        compresslevel (int, optional): Compression level when appending to a
+            .gz, .bz2 or .xz file.
+    """
+
+    def __init__(self, csvpath: PathLike, delimiter=",", encoding="utf-8", max_rows=1000, max_bytes=1024 * 1024, flush_interval: float = 1.0, fsync=False, compresslevel: int = None):
+        self.csvpath = csvpath
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._buffer = io.StringIO()
+        self._writer = pycsv.writer(self._buffer, delimiter=delimiter)
+        self._buffered_rows = 0
+        self._file = _open_csv(csvpath, "a", encoding=encoding, newline="", compresslevel=compresslevel)
+        self._closed = False
+        self._stop = threading.Event()
+        self._flusher = None
+        if flush_interval:
+            self._flusher = threading.Thread(target=self._flush_periodically, args=(flush_interval,), daemon=True)
+            self._flusher.start()
+
+    def __enter__(self) -> "CsvAppender":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def append_row(self, row: List[str]) -> None:
+        """
+        Buffers a single row, flushing if a size limit is reached.
+
+        Args:
+            row: A list of strings
+        """
+        with self._lock:
+            self._check_open()
+            self._writer.writerow(row)
+            self._buffered_rows += 1
+            self._flush_if_full()
+
+    def append_rows(self, list_of_rows: List[List[str]]) -> None:
+        """
+        Buffers multiple rows, flushing if a size limit is reached.
+
+        Args:
+            list_of_rows: 2D list of strings
+        """
+        with self._lock:
+            self._check_open()
+            for row in list_of_rows:
+                self._writer.writerow(row)
+                self._buffered_rows += 1
+                self._flush_if_full()
+
+    def flush(self) -> None:
+        """
+        Writes all buffered rows to the file.
+        """
+        with self._lock:
+            if not self._closed:
+                self._flush()
+
+    def close(self) -> None:
+        """
+        Flushes buffered rows, stops the background flusher and closes the file.
+        """
+        self._stop.set()
+        with self._lock:
+            if self._closed:
+                return
+            try:
+                self._flush()
+            finally:
+                self._closed = True
+                self._file.close()
+        if self._flusher is not None and self._flusher is not threading.current_thread():
+            self._flusher.join()
+
+    def _check_open(self) -> None:
+        if self._closed:
+            raise ValueError(f"CsvAppender for {self.csvpath} is closed")
+
+    def _flush_if_full(self) -> None:
+        if self._buffered_rows >= self.max_rows or self._buffer.tell() >= self.max_bytes:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._buffered_rows:
+            self._file.write(self._buffer.getvalue())
+            self._buffer.seek(0)
+            self._buffer.truncate()
+            self._buffered_rows = 0
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def _flush_periodically(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            self.flush()
+
+
+def close_shared_appenders() -> None:
+    """
+    Flushes and closes the appenders used by append_row/append_rows with
+    buffered=True. Also runs automatically at interpreter exit.
+    """
+    with _shared_appenders_lock:
+        appenders = list(_shared_appenders.values())
+        _shared_appenders.clear()
+    for appender in appenders:
+        appender.close()
+
+
+def _get_shared_appender(csvpath: PathLike, delimiter: str, encoding: str) -> CsvAppender:
+    key = (os.path.abspath(csvpath), delimiter, encoding)
+    with _shared_appenders_lock:
+        appender = _shared_appenders.get(key)
+        if appender is None or appender.closed:
+            appender = _shared_appenders[key] = CsvAppender(csvpath, delimiter=delimiter, encoding=encoding)
+        return appender
+
+
+atexit.register(close_shared_appenders)
+
+
+def get_rows_by_column_filter(filepath: PathLike, col_index: int, col_value: Any, delimiter=",", encoding="utf-8", use_index=False, workers: int = None, ordered=True, prefilter=False) -> Generator[List[str], None, None]:
     """
     Returns rows where certain values occur in a certain column. Like v-lookups in excel.
 
@@ -87,10 +328,1254 @@ def get_rows_by_column_filter(filepath: PathLike, col_index: int, col_value: Any
         col_value: Value of column to filter on
         delimiter: Row delimiter. Defaults to ",".
         encoding: File encoding. Defaults to "utf-8".
+        use_index (bool, optional): Look rows up through a sidecar column index
+            (see build_column_index) instead of scanning the whole file. The index is
+            built on first use and rebuilt when the file's size or mtime changes.
+            Defaults to False.
+        workers (int, optional): Number of processes to scan the file with, rows
+            are filtered inside the workers. See get_rows. Defaults to None.
+        ordered (bool, optional): With workers, whether rows come back in file
+            order. Defaults to True.
+        prefilter (bool, optional): Memory map the file and search its raw bytes for
+            the encoded col_value, only decoding and parsing the rows containing it.
+            Much faster for selective lookups. Defaults to False.
+
+    use_index, workers and prefilter need an ASCII compatible encoding and an
+    uncompressed file, otherwise the whole file is scanned.
 
     Yields:
         List of strings representing rows
     """
+    # the byte offset based modes need the raw file in an ASCII compatible
+    # encoding, other files are scanned
+    raw = _compression_of(filepath) is None and _is_ascii_compatible(encoding, delimiter)
+
+    if use_index and raw:
+        yield from _get_rows_from_index(filepath, col_index, col_value, delimiter, encoding)
+        return
+
+    if workers is not None and workers > 1 and raw:
+        yield from _get_rows_parallel(filepath, False, delimiter, encoding, workers, ordered, (col_index, col_value))
+        return
+
+    if prefilter and raw:
+        yield from _get_rows_prefiltered(filepath, col_index, col_value, delimiter, encoding)
+        return
+
     for row in get_rows(filepath, delimiter=delimiter, encoding=encoding):
         if row[col_index] == col_value:
             yield row
+
+
+def _compression_of(csvpath: PathLike, mode="r") -> Optional[str]:
+    """
+    Returns "gzip", "bz2", "lzma" or None for the csv file. Existing files are
+    recognized by their magic bytes when read or appended to, new ones by extension.
+    """
+    if mode != "w":
+        try:
+            with open(csvpath, "rb") as f:
+                head = f.read(6)
+        except FileNotFoundError:
+            head = b""
+        for magic, compression in _COMPRESSION_MAGIC:
+            if head.startswith(magic):
+                return compression
+        if head:
+            return None
+    return _COMPRESSION_SUFFIXES.get(Path(csvpath).suffix.lower())
+
+
+def _open_csv(csvpath: PathLike, mode: str, encoding: str, newline: str = None, compresslevel: int = None):
+    """
+    Opens a csv file in text mode, streaming through gzip, bz2 or xz when the
+    file is compressed. Decompressed data is read in large blocks.
+    """
+    compression = _compression_of(csvpath, mode)
+    if compression is None:
+        return open(csvpath, mode, encoding=encoding, newline=newline)
+
+    binary_mode = mode + "b"
+    if compression == "gzip":
+        stream = gzip.open(csvpath, binary_mode, compresslevel=9 if compresslevel is None else compresslevel)
+    elif compression == "bz2":
+        stream = bz2.open(csvpath, binary_mode, compresslevel=9 if compresslevel is None else compresslevel)
+    else:
+        stream = lzma.open(csvpath, binary_mode, preset=compresslevel if mode != "r" else None)
+    if mode == "r":
+        stream = io.BufferedReader(stream, buffer_size=_READ_BUFFER_SIZE)
+    return io.TextIOWrapper(stream, encoding=encoding, newline=newline)
+
+
+def build_column_index(filepath: PathLike, col_index: int, delimiter=",", encoding="utf-8") -> Path:
+    """
+    Builds a sidecar hash index mapping each value of a column to the byte
+    offsets of the rows holding it, and writes it next to the csv file as
+    <filename>.col<col_index>.idx.
+    The encoding must be ASCII compatible (utf-8, latin-1, cp1252...).
+
+    Args:
+        filepath: Path of file
+        col_index: 0 based col index to index
+        delimiter: Row delimiter. Defaults to ",".
+        encoding: File encoding. Defaults to "utf-8".
+
+    Returns:
+        Path of the index file
+    """
+    if not _is_ascii_compatible(encoding, delimiter):
+        raise ValueError(f"column indexes need an ASCII compatible encoding, not {encoding!r}")
+    _, index_path = _build_column_index(filepath, col_index, delimiter, encoding)
+    return index_path
+
+
+def _is_ascii_compatible(encoding: str, delimiter=",") -> bool:
+    """
+    Whether the encoding stores newlines, quotes and the delimiter as their
+    single ASCII bytes, which the byte offset based scans search for.
+    """
+    markers = "\n\r\"" + delimiter
+    try:
+        return markers.encode(encoding) == markers.encode("ascii")
+    except (LookupError, UnicodeEncodeError):
+        return False
+
+
+def _index_path(filepath: PathLike, col_index: int) -> Path:
+    return Path(str(filepath) + f".col{col_index}.idx")
+
+
+def _read_record(f) -> bytes:
+    """
+    Reads one csv record from a binary file object positioned at a record
+    boundary, following newlines inside quoted fields. Returns b"" at end of file.
+    """
+    record = f.readline()
+    quotes = record.count(_QUOTE)
+    while quotes % 2:
+        line = f.readline()
+        if not line:
+            break
+        record += line
+        quotes += line.count(_QUOTE)
+    return record
+
+
+def _iter_records(f, end: int = None) -> Generator[Tuple[int, bytes], None, None]:
+    """
+    Yields (offset, raw record) pairs from the current position of a binary
+    file object until end of file or until the end offset is reached.
+    """
+    offset = f.tell()
+    while end is None or offset < end:
+        record = _read_record(f)
+        if not record:
+            break
+        yield offset, record
+        offset += len(record)
+
+
+def _parse_records(data: bytes, delimiter: str, encoding: str) -> List[List[str]]:
+    """
+    Parses raw csv bytes the same way get_rows would, universal newlines included.
+    """
+    return list(pycsv.reader(io.StringIO(data.decode(encoding), newline=None), delimiter=delimiter))
+
+
+def _build_column_index(filepath: PathLike, col_index: int, delimiter: str, encoding: str) -> Tuple[Dict[str, List[int]], Path]:
+    stat = os.stat(filepath)
+    offsets = {}
+    with open(filepath, "rb") as f:
+        for offset, record in _iter_records(f):
+            for row in _parse_records(record, delimiter, encoding):
+                try:
+                    value = row[col_index]
+                except IndexError:
+                    continue
+                row_offsets = offsets.setdefault(value, [])
+                # a record may parse into several rows, keep its offset once
+                if not row_offsets or row_offsets[-1] != offset:
+                    row_offsets.append(offset)
+
+    index = {
+        "version": _INDEX_VERSION,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "col_index": col_index,
+        "delimiter": delimiter,
+        "encoding": encoding,
+        "offsets": offsets,
+    }
+    index_path = _index_path(filepath, col_index)
+    # unique per writer, several processes may rebuild the same index at once
+    temp_path = Path(str(index_path) + f".{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        # marshal rather than pickle, loading a sidecar file must not run code
+        with open(temp_path, "wb") as f:
+            marshal.dump(index, f)
+        os.replace(temp_path, index_path)
+    except OSError:
+        # read only location, the index still serves this process from memory
+        if temp_path.exists():
+            os.remove(temp_path)
+
+    _remember_index(_index_cache_key(filepath, col_index, delimiter, encoding), stat, offsets)
+    return offsets, index_path
+
+
+def _index_cache_key(filepath: PathLike, col_index: int, delimiter: str, encoding: str) -> tuple:
+    return (os.path.abspath(filepath), col_index, delimiter, encoding)
+
+
+def _remember_index(key: tuple, stat: os.stat_result, offsets: Dict[str, List[int]]) -> None:
+    # indexes of large files are large, only the most recently used stay in memory
+    with _index_cache_lock:
+        _index_cache[key] = (stat.st_size, stat.st_mtime_ns, offsets)
+        _index_cache.move_to_end(key)
+        if len(_index_cache) > _INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+
+
+def _load_column_index(filepath: PathLike, col_index: int, delimiter: str, encoding: str) -> Dict[str, List[int]]:
+    """
+    Returns the offsets of a column index which is still valid for the file,
+    from memory, from the sidecar file or freshly built, in that order.
+    """
+    stat = os.stat(filepath)
+    key = _index_cache_key(filepath, col_index, delimiter, encoding)
+    with _index_cache_lock:
+        cached = _index_cache.get(key)
+        if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            _index_cache.move_to_end(key)
+            return cached[2]
+
+    try:
+        with open(_index_path(filepath, col_index), "rb") as f:
+            index = marshal.load(f)
+    except (OSError, ValueError, EOFError, TypeError):
+        index = None
+
+    if (
+        isinstance(index, dict)
+        and index.get("version") == _INDEX_VERSION
+        and index.get("size") == stat.st_size
+        and index.get("mtime_ns") == stat.st_mtime_ns
+        and index.get("col_index") == col_index
+        and index.get("delimiter") == delimiter
+        and index.get("encoding") == encoding
+    ):
+        _remember_index(key, stat, index["offsets"])
+        return index["offsets"]
+
+    offsets, _ = _build_column_index(filepath, col_index, delimiter, encoding)
+    return offsets
+
+
+def _get_rows_from_index(filepath: PathLike, col_index: int, col_value: Any, delimiter: str, encoding: str) -> Generator[List[str], None, None]:
+    if not isinstance(col_value, str):
+        # csv values are always strings, nothing else can match
+        return
+    offsets = _load_column_index(filepath, col_index, delimiter, encoding)
+
+    with open(filepath, "rb") as f:
+        for offset in offsets.get(col_value, []):
+            f.seek(offset)
+            for row in _parse_records(_read_record(f), delimiter, encoding):
+                try:
+                    matches = row[col_index] == col_value
+                except IndexError:
+                    continue
+                if matches:
+                    yield row
+
+
+def _count_quotes(f, start: int, end: int) -> int:
+    f.seek(start)
+    quotes = 0
+    remaining = end - start
+    while remaining > 0:
+        block = f.read(min(_BLOCK_SIZE, remaining))
+        if not block:
+            break
+        quotes += block.count(_QUOTE)
+        remaining -= len(block)
+    return quotes
+
+
+def _chunk_ranges(csvpath: PathLike, chunk_size: int) -> Generator[Tuple[int, int], None, None]:
+    """
+    Lazily splits a csv file into (start, end) byte ranges of roughly
+    chunk_size bytes which begin and end on record boundaries. A line end only
+    counts as a boundary when the quotes seen so far are balanced, so quoted
+    newlines never split a record. Ranges are yielded as soon as their end is
+    found, so workers can parse them while the rest of the file is scanned.
+    """
+    size = os.path.getsize(csvpath)
+    if not size:
+        return
+    with open(csvpath, "rb") as f:
+        quotes = 0
+        start = pos = 0
+        for target in range(chunk_size, size, chunk_size):
+            if target <= pos:
+                continue
+            quotes += _count_quotes(f, pos, target)
+            # finish the current line, then keep going until outside quotes
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                quotes += line.count(_QUOTE)
+                if quotes % 2 == 0:
+                    break
+            pos = f.tell()
+            if pos >= size:
+                break
+            yield start, pos
+            start = pos
+    yield start, size
+
+
+def _parse_chunk(csvpath: PathLike, start: int, end: int, skip_header: bool, delimiter: str, encoding: str, column_filter: Tuple[int, Any] = None) -> List[List[str]]:
+    with open(csvpath, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    rows = _parse_records(data, delimiter, encoding)
+    if skip_header:
+        rows = rows[1:]
+    if column_filter is not None:
+        col_index, col_value = column_filter
+        rows = [row for row in rows if row[col_index] == col_value]
+    return rows
+
+
+def _get_rows_parallel(csvpath: PathLike, skip_header: bool, delimiter: str, encoding: str, workers: int, ordered: bool, column_filter: Tuple[int, Any] = None) -> Generator[List[str], None, None]:
+    size = os.path.getsize(csvpath)
+    # several ranges per worker to balance load, capped so a range fits in memory
+    chunk_size = max(min(size // (workers * 4), _PARALLEL_CHUNK_SIZE), _BLOCK_SIZE)
+    ranges = _chunk_ranges(csvpath, chunk_size)
+    max_pending = workers * 2
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+
+        def submit_next() -> bool:
+            for start, end in ranges:
+                pending.append(executor.submit(
+                    _parse_chunk, csvpath, start, end, skip_header and start == 0, delimiter, encoding, column_filter
+                ))
+                return True
+            return False
+
+        while len(pending) < max_pending and submit_next():
+            pass
+
+        while pending:
+            if ordered:
+                done = pending.popleft()
+            else:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                done = finished.pop()
+                pending.remove(done)
+            rows = done.result()
+            submit_next()
+            yield from rows
+
+
+def _get_rows_prefiltered(filepath: PathLike, col_index: int, col_value: Any, delimiter: str, encoding: str) -> Generator[List[str], None, None]:
+    if not isinstance(col_value, str):
+        # csv values are always strings, nothing else can match
+        return
+
+    needle = col_value.encode(encoding)
+    if not needle or _QUOTE in needle or b"\n" in needle or b"\r" in needle:
+        # such values are not stored verbatim in the file, fall back to a full scan
+        for row in get_rows(filepath, delimiter=delimiter, encoding=encoding):
+            if row[col_index] == col_value:
+                yield row
+        return
+
+    with open(filepath, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            has_quotes = mm.find(_QUOTE) != -1
+            pos = 0  # a record boundary, everything before it is handled
+            while True:
+                hit = mm.find(needle, pos)
+                if hit == -1:
+                    break
+
+                start = mm.rfind(b"\n", pos, hit) + 1 or pos
+                if has_quotes:
+                    # walk back while the line start sits inside a quoted field
+                    quotes = _count_quotes(mm, pos, start)
+                    while quotes % 2:
+                        new_start = mm.rfind(b"\n", pos, start - 1) + 1 or pos
+                        quotes -= _count_quotes(mm, new_start, start)
+                        start = new_start
+
+                mm.seek(start)
+                record = _read_record(mm)
+                for row in _parse_records(record, delimiter, encoding):
+                    if row[col_index] == col_value:
+                        yield row
+                pos = start + len(record)
+
+
+def get_column_batches(csvpath: PathLike, batch_size=10000, columns: Sequence[Union[int, str]] = None, types: Dict[Union[int, str], type] = None, skip_header=False, delimiter=",", encoding="utf-8", use_numpy=False) -> Generator[Dict[Union[int, str], Sequence], None, None]:
+    """
+    Yields the csv file in batches of rows stored column by column.
+    Numeric columns are stored in array.array (or numpy arrays) instead of
+    lists of strings.
+
+    Example:
+        Summing a column::
+
+            >>> total = 0
+            >>> for batch in get_column_batches("sales.csv", columns=["amount"], skip_header=True):
+            ...     total += sum(batch["amount"])
+
+    Args:
+        csvpath: Path to csv file
+        batch_size (int, optional): Number of rows per batch. Defaults to 10000.
+        columns (optional): Columns to load, as 0 based indexes or header names.
+            Other columns are never materialized. Defaults to all columns.
+        types (optional): Mapping of column to int, float or str. Columns without a
+            declared type are inferred from the first batch, and widened from int
+            to float to str if a later batch does not fit.
+        skip_header: Whether the first row is a header. Its names become usable in
+            columns/types and are used as batch keys. Defaults to False.
+        delimiter: Row delimiter character, default ","
+        encoding: File encoding, default "utf-8"
+        use_numpy (bool, optional): Store numeric columns in numpy arrays. Requires
+            numpy. Defaults to False.
+
+    Yields:
+        Dictionary of column (as given in columns, or header name/index) to values
+    """
+    if use_numpy:
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError("get_column_batches(use_numpy=True) requires numpy to be installed")
+    else:
+        numpy = None
+
+    rows = get_rows(csvpath, delimiter=delimiter, encoding=encoding)
+    header = next(rows, None) if skip_header else None
+    if columns is None:
+        if header is not None:
+            columns = header
+        else:
+            first = next(rows, None)
+            if first is None:
+                return
+            columns = list(range(len(first)))
+            rows = chain([first], rows)
+
+    positions = [_column_position(column, header) for column in columns]
+    declared = {_column_position(column, header): kind for column, kind in (types or {}).items()}
+    kinds = dict(declared)
+
+    while True:
+        chunk = list(islice(rows, batch_size))
+        if not chunk:
+            return
+        batch = {}
+        for column, position in zip(columns, positions):
+            values = [row[position] for row in chunk]
+            kind = kinds.get(position)
+            if position in declared:
+                try:
+                    batch[column] = _to_column(values, kind, numpy)
+                except (ValueError, OverflowError) as e:
+                    # ints beyond 64 bits don't fit the typed array, that's a type mismatch too
+                    raise ValueError(f"column {column!r} is not of declared type {kind.__name__}: {e}")
+                continue
+            for kind in _WIDENING[_WIDENING.index(kind) if kind else 0:]:
+                try:
+                    batch[column] = _to_column(values, kind, numpy)
+                    break
+                except (ValueError, OverflowError):
+                    continue
+            kinds[position] = kind
+        yield batch
+
+
+def _column_position(column: Union[int, str], header: List[str], header_flag="skip_header") -> int:
+    """
+    Resolves a column index or header name to an index. header_flag names the
+    caller's parameter enabling the header, for the error message.
+    """
+    if isinstance(column, int):
+        return column
+    if header is None:
+        raise ValueError(f"column {column!r} referenced by name without a header row, use {header_flag}=True")
+    try:
+        return header.index(column)
+    except ValueError:
+        raise ValueError(f"column {column!r} not found in header {header}")
+
+
+def _parse_float(value: str) -> float:
+    return float(value) if value.strip() else float("nan")
+
+
+def _to_column(values: List[str], kind: type, numpy=None) -> Sequence:
+    if kind is int:
+        if numpy is not None:
+            return numpy.array(list(map(int, values)), dtype=numpy.int64)
+        return array("q", map(int, values))
+    if kind is float:
+        try:
+            floats = list(map(float, values))
+        except ValueError:
+            # empty cells become nan
+            floats = list(map(_parse_float, values))
+        if numpy is not None:
+            return numpy.array(floats, dtype=numpy.float64)
+        return array("d", floats)
+    if kind is str:
+        return values
+    raise ValueError(f"unsupported column type {kind!r}, use int, float or str")
+
+
+class Predicate:
+    """
+    A row condition for query_csv, built from Column comparisons and combined
+    with & (and), | (or) and ~ (not). It is compiled once per query into
+    plain closures over resolved column indexes.
+    """
+
+    def __init__(self, build: Callable[[Callable[[Union[int, str]], int]], Callable[[List[str]], bool]]):
+        self._build = build
+
+    def __and__(self, other: "Predicate") -> "Predicate":
+        return Predicate(lambda resolve: _and(self._build(resolve), other._build(resolve)))
+
+    def __or__(self, other: "Predicate") -> "Predicate":
+        return Predicate(lambda resolve: _or(self._build(resolve), other._build(resolve)))
+
+    def __invert__(self) -> "Predicate":
+        return Predicate(lambda resolve: _not(self._build(resolve)))
+
+    def compile(self, header: List[str] = None) -> Callable[[List[str]], bool]:
+        """
+        Returns a function testing a row against this predicate.
+
+        Args:
+            header (optional): Header row used to resolve column names
+
+        Returns:
+            Function taking a row and returning True or False
+        """
+        return self._build(lambda column: _column_position(column, header))
+
+
+class Column:
+    """
+    Reference to a csv column by 0 based index or header name, used to build
+    query_csv predicates.
+
+    Example:
+        Building a predicate::
+
+            >>> (Column("age", int) >= 18) & Column("country").isin({"CA", "US"})
+
+    Args:
+        column: Column index or header name
+        cast (optional): Conversion applied to the cell before comparing, ex int.
+            Cells which fail to convert do not match. Defaults to comparing strings.
+    """
+
+    def __init__(self, column: Union[int, str], cast: Callable[[str], Any] = None):
+        self.column = column
+        self.cast = cast
+
+    def __eq__(self, value: Any) -> Predicate:
+        return self._compare(operator.eq, value)
+
+    def __ne__(self, value: Any) -> Predicate:
+        return self._compare(operator.ne, value)
+
+    def __lt__(self, value: Any) -> Predicate:
+        return self._compare(operator.lt, value)
+
+    def __le__(self, value: Any) -> Predicate:
+        return self._compare(operator.le, value)
+
+    def __gt__(self, value: Any) -> Predicate:
+        return self._compare(operator.gt, value)
+
+    def __ge__(self, value: Any) -> Predicate:
+        return self._compare(operator.ge, value)
+
+    __hash__ = None
+
+    def between(self, low: Any, high: Any) -> Predicate:
+        """
+        Matches cells in the inclusive range [low, high].
+        """
+        return self._test(lambda cell: low <= cell <= high)
+
+    def isin(self, values: Iterable[Any]) -> Predicate:
+        """
+        Matches cells equal to one of the values.
+        """
+        values = frozenset(values)
+        return self._test(values.__contains__)
+
+    def startswith(self, prefix: Union[str, Tuple[str, ...]]) -> Predicate:
+        """
+        Matches cells starting with the prefix, or any of a tuple of prefixes.
+        """
+        return self._test(lambda cell: str(cell).startswith(prefix))
+
+    def matches(self, pattern: Union[str, "re.Pattern"]) -> Predicate:
+        """
+        Matches cells in which the regular expression is found.
+        """
+        search = re.compile(pattern).search
+        return self._test(lambda cell: search(str(cell)) is not None)
+
+    def _compare(self, op: Callable[[Any, Any], bool], value: Any) -> Predicate:
+        return self._test(lambda cell: op(cell, value))
+
+    def _test(self, test: Callable[[Any], bool]) -> Predicate:
+        column, cast = self.column, self.cast
+
+        def build(resolve):
+            index = resolve(column)
+            if cast is None:
+                def row_test(row):
+                    try:
+                        return test(row[index])
+                    except IndexError:
+                        return False
+            else:
+                def row_test(row):
+                    try:
+                        return test(cast(row[index]))
+                    except (IndexError, ValueError, TypeError):
+                        return False
+            return row_test
+
+        return Predicate(build)
+
+
+def _and(left: Callable[[List[str]], bool], right: Callable[[List[str]], bool]) -> Callable[[List[str]], bool]:
+    return lambda row: left(row) and right(row)
+
+
+def _or(left: Callable[[List[str]], bool], right: Callable[[List[str]], bool]) -> Callable[[List[str]], bool]:
+    return lambda row: left(row) or right(row)
+
+
+def _not(test: Callable[[List[str]], bool]) -> Callable[[List[str]], bool]:
+    return lambda row: not test(row)
+
+
+def query_csv(csvpath: PathLike, where: Predicate = None, columns: Sequence[Union[int, str]] = None, limit: int = None, skip_header=True, delimiter=",", encoding="utf-8") -> Generator[List[str], None, None]:
+    """
+    Streams the rows of a csv file matching a predicate, optionally keeping
+    only some columns and stopping after a number of rows.
+
+    Example:
+        Querying by header names::
+
+            >>> where = (Column("age", int).between(18, 65)) & Column("email").matches(r"@example\\.com$")
+            >>> for name, email in query_csv("people.csv", where, columns=["name", "email"], limit=10):
+            ...     print(name, email)
+
+    Args:
+        csvpath: Path to csv file
+        where (optional): Predicate built from Column. Defaults to all rows.
+        columns (optional): Columns to return, as indexes or header names. Defaults to all.
+        limit (optional): Maximum number of rows to yield. Reading stops once reached.
+        skip_header: Whether the first row is a header whose names can be used to
+            reference columns. Defaults to True.
+        delimiter: Row delimiter character, default ","
+        encoding: File encoding, default "utf-8"
+
+    Yields:
+        List of strings representing the matching rows
+    """
+    if limit is not None and limit <= 0:
+        return
+
+    rows = get_rows(csvpath, delimiter=delimiter, encoding=encoding)
+    try:
+        header = next(rows, None) if skip_header else None
+        test = where.compile(header) if where is not None else None
+        positions = [_column_position(column, header) for column in columns] if columns is not None else None
+
+        matched = 0
+        for row in rows if test is None else filter(test, rows):
+            yield row if positions is None else [row[i] for i in positions]
+            matched += 1
+            if matched == limit:
+                return
+    finally:
+        rows.close()
+
+
+def tail_rows(csvpath: PathLike, checkpoint_path: PathLike = None, skip_header=False, follow=False, poll_interval=1.0, delimiter=",", encoding="utf-8") -> Generator[List[str], None, None]:
+    """
+    Yields the rows appended to a csv file since the last call, resuming from
+    a checkpoint file holding the byte offset reached and the file's identity.
+    A trailing row without its line ending is held back until it is complete.
+    If the file was truncated or replaced (rotated) reading restarts at the
+    beginning.
+    The checkpoint is saved when the generator finishes or is closed, and
+    after every poll in follow mode. Rows yielded before a crash may be
+    yielded again.
+
+    Args:
+        csvpath: Path to csv file
+        checkpoint_path (optional): Path of the checkpoint file.
+            Defaults to <csvpath>.checkpoint
+        skip_header: Whether to skip the header row, default False
+        follow (bool, optional): Keep polling the file for new rows forever
+            instead of stopping at its end. Defaults to False.
+        poll_interval (float, optional): Seconds between polls when following.
+            Defaults to 1.0.
+        delimiter: Row delimiter character, default ","
+        encoding: File encoding, default "utf-8"
+
+    Yields:
+        List of strings representing rows
+    """
+    if _compression_of(csvpath) is not None:
+        raise ValueError(f"tail_rows cannot resume inside compressed file {csvpath}")
+
+    checkpoint_path = checkpoint_path if checkpoint_path is not None else Path(str(csvpath) + ".checkpoint")
+    checkpoint = _load_tail_checkpoint(checkpoint_path)
+
+    try:
+        while True:
+            try:
+                f = open(csvpath, "rb")
+            except FileNotFoundError:
+                # mid rotation, the new file is not there yet
+                if not follow:
+                    raise
+            else:
+                with f:
+                    checkpoint = _validate_tail_checkpoint(f, checkpoint)
+                    f.seek(checkpoint["offset"])
+                    for start, record in _iter_records(f):
+                        if not record.endswith(b"\n") or record.count(_QUOTE) % 2:
+                            break
+                        checkpoint["offset"] = start + len(record)
+                        if skip_header and start == 0:
+                            continue
+                        yield from _parse_records(record, delimiter, encoding)
+
+            if not follow:
+                return
+            _save_tail_checkpoint(checkpoint_path, checkpoint)
+            time.sleep(poll_interval)
+    finally:
+        if checkpoint is not None:
+            _save_tail_checkpoint(checkpoint_path, checkpoint)
+
+
+def _read_head(f, size: int) -> str:
+    """
+    Returns the first bytes of the file (at most _CHECKPOINT_HEAD_SIZE) as hex,
+    used to tell a rotated file apart from the checkpointed one.
+    """
+    f.seek(0)
+    return f.read(min(size, _CHECKPOINT_HEAD_SIZE)).hex()
+
+
+def _validate_tail_checkpoint(f, checkpoint: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Returns the checkpoint if it still describes the open file, or a fresh
+    one starting at offset 0 if the file is new, rotated or truncated.
+    """
+    stat = os.fstat(f.fileno())
+    if (
+        checkpoint is not None
+        and checkpoint["device"] == stat.st_dev
+        and checkpoint["inode"] == stat.st_ino
+        and checkpoint["offset"] <= stat.st_size
+        and _read_head(f, len(checkpoint["head"]) // 2) == checkpoint["head"]
+    ):
+        checkpoint["head"] = _read_head(f, stat.st_size)
+        return checkpoint
+    return {"offset": 0, "device": stat.st_dev, "inode": stat.st_ino, "head": _read_head(f, stat.st_size)}
+
+
+def _load_tail_checkpoint(checkpoint_path: PathLike) -> Dict[str, Any]:
+    try:
+        with open(checkpoint_path, "r", encoding="utf-8") as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(checkpoint, dict) or not {"offset", "device", "inode", "head"} <= set(checkpoint):
+        return None
+    return checkpoint
+
+
+def _save_tail_checkpoint(checkpoint_path: PathLike, checkpoint: Dict[str, Any]) -> None:
+    temp_path = Path(str(checkpoint_path) + ".tmp")
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+    os.replace(temp_path, checkpoint_path)
+
+
+def sort_csv(csvpath: PathLike, key_columns: Sequence[Union[int, str]], out_path: PathLike = None, numeric=False, reverse=False, header=False, memory_limit=_SORT_MEMORY_LIMIT, workers: int = None, delimiter=",", encoding="utf-8") -> Union[Path, Generator[List[str], None, None]]:
+    """
+    Sorts a csv file of any size using bounded memory. Rows are collected up to
+    memory_limit, sorted and spilled to temporary run files, which are then
+    k-way merged. The sort is stable.
+
+    Args:
+        csvpath: Path to csv file
+        key_columns: Columns to sort on, as indexes or header names
+        out_path (optional): File to write the sorted rows to. If not given a
+            generator of sorted rows is returned instead.
+        numeric (bool, optional): Compare key columns as numbers, empty cells
+            sort before all numbers. Defaults to False.
+        reverse (bool, optional): Sort in descending order. Defaults to False.
+        header (bool, optional): Whether the first row is a header. It is kept as the
+            first row of the output. Defaults to False.
+        memory_limit (int, optional): Approximate bytes of rows held in memory per
+            run. Defaults to 256 MB.
+        workers (int, optional): Number of processes sorting and spilling runs in
+            parallel. Each holds up to memory_limit. Defaults to None.
+        delimiter: Row delimiter character, default ","
+        encoding: File encoding, default "utf-8"
+
+    Returns:
+        out_path, or a generator of sorted rows if out_path is None
+    """
+    rows = _sorted_rows(csvpath, key_columns, numeric, reverse, header, memory_limit, workers, delimiter, encoding)
+    if out_path is None:
+        return rows
+    return _write_rows_replacing(out_path, rows, delimiter, encoding)
+
+
+def group_by_csv(csvpath: PathLike, key_columns: Sequence[Union[int, str]], aggregations: Sequence[Tuple[Union[int, str], str]], out_path: PathLike = None, header=False, memory_limit=_SORT_MEMORY_LIMIT, workers: int = None, delimiter=",", encoding="utf-8") -> Union[Path, Generator[List[str], None, None]]:
+    """
+    Groups the rows of a csv file of any size by key columns and aggregates
+    other columns. Built on sort_csv, so memory stays bounded and groups come
+    out sorted by key.
+
+    Example:
+        Total and average amount per customer::
+
+            >>> group_by_csv("orders.csv", ["customer"], [("amount", "sum"), ("amount", "mean")], header=True)
+
+    Args:
+        csvpath: Path to csv file
+        key_columns: Columns to group on, as indexes or header names
+        aggregations: (column, function) pairs where function is one of count, sum,
+            mean, min, max, first or last. sum, mean, min and max are numeric.
+        out_path (optional): File to write the groups to. If not given a generator
+            of groups is returned instead.
+        header (bool, optional): Whether the first row is a header. The output then
+            starts with a header row of key names and <function>_<column> names.
+            Defaults to False.
+        memory_limit (int, optional): See sort_csv. Defaults to 256 MB.
+        workers (int, optional): See sort_csv. Defaults to None.
+        delimiter: Row delimiter character, default ","
+        encoding: File encoding, default "utf-8"
+
+    Returns:
+        out_path, or a generator of rows made of key values followed by the aggregates
+    """
+    for _, function in aggregations:
+        if function not in _AGGREGATIONS:
+            raise ValueError(f"unknown aggregation {function!r}, use one of {_AGGREGATIONS}")
+
+    rows = _grouped_rows(csvpath, key_columns, aggregations, header, memory_limit, workers, delimiter, encoding)
+    if out_path is None:
+        return rows
+    return _write_rows_replacing(out_path, rows, delimiter, encoding)
+
+
+def _write_rows_replacing(out_path: PathLike, rows: Iterable[List[str]], delimiter: str, encoding: str) -> Path:
+    """
+    Writes rows to a temp file next to out_path and moves it over out_path
+    once done, so out_path may be one of the files the rows are read from.
+    """
+    out_path = Path(out_path)
+    # keep the suffix so the temp file is compressed like out_path
+    temp_path = out_path.with_name(f"{out_path.stem}.{os.getpid()}.{threading.get_ident()}.tmp{out_path.suffix}")
+    try:
+        write_rows(temp_path, rows, delimiter=delimiter, encoding=encoding)
+        os.replace(temp_path, out_path)
+    except BaseException:
+        if temp_path.exists():
+            os.remove(temp_path)
+        raise
+    return out_path
+
+
+def _grouped_rows(csvpath: PathLike, key_columns: Sequence[Union[int, str]], aggregations: Sequence[Tuple[Union[int, str], str]], header: bool, memory_limit: int, workers: int, delimiter: str, encoding: str) -> Generator[List[str], None, None]:
+    rows = _sorted_rows(csvpath, key_columns, False, False, header, memory_limit, workers, delimiter, encoding)
+    header_row = next(rows, None) if header else None
+    if header and header_row is None:
+        return
+    key_positions = [_column_position(column, header_row, "header") for column in key_columns]
+    agg_positions = [(_column_position(column, header_row, "header"), function) for column, function in aggregations]
+    if header_row is not None:
+        yield [header_row[i] for i in key_positions] + [f"{function}_{header_row[i]}" for i, function in agg_positions]
+
+    for key, group in groupby(rows, key=lambda row: [row[i] for i in key_positions]):
+        yield key + _aggregate(group, agg_positions)
+
+
+def _aggregate(group: Iterable[List[str]], agg_positions: List[Tuple[int, str]]) -> List[Any]:
+    """
+    Computes every aggregation of a group in one pass over its rows, keeping a
+    single running value per aggregation, so groups of any size fit in memory.
+    """
+    count = 0
+    states = [None] * len(agg_positions)
+    for row in group:
+        count += 1
+        for n, (index, function) in enumerate(agg_positions):
+            if function == "count":
+                continue
+            if function == "first":
+                if count == 1:
+                    states[n] = row[index]
+            elif function == "last":
+                states[n] = row[index]
+            else:
+                value = float(row[index])
+                state = states[n]
+                if state is None:
+                    states[n] = value
+                elif function in ("sum", "mean"):
+                    states[n] = state + value
+                elif function == "min":
+                    states[n] = min(state, value)
+                else:
+                    states[n] = max(state, value)
+
+    results = []
+    for (_, function), state in zip(agg_positions, states):
+        if function == "count":
+            results.append(count)
+        elif function in ("first", "last"):
+            results.append(state)
+        else:
+            result = state / count if function == "mean" else state
+            results.append(int(result) if result.is_integer() else result)
+    return results
+
+
+def _sorted_rows(csvpath: PathLike, key_columns: Sequence[Union[int, str]], numeric: bool, reverse: bool, header: bool, memory_limit: int, workers: int, delimiter: str, encoding: str) -> Generator[List[str], None, None]:
+    rows = get_rows(csvpath, delimiter=delimiter, encoding=encoding)
+    header_row = next(rows, None) if header else None
+    if header_row is not None:
+        yield header_row
+    key_spec = ([_column_position(column, header_row, "header") for column in key_columns], numeric)
+    key = _make_sort_key(*key_spec)
+
+    with TemporaryDirectory() as temp:
+        executor = ProcessPoolExecutor(max_workers=workers) if workers is not None and workers > 1 else None
+        runs = []
+        pending = deque()
+        try:
+            buffer, used = [], 0
+            for row in rows:
+                buffer.append(row)
+                used += _estimate_row_size(row)
+                if used < memory_limit:
+                    continue
+                run_path = Path(temp) / f"run{len(runs)}"
+                runs.append(run_path)
+                if executor is None:
+                    _sort_and_spill(buffer, run_path, key_spec, reverse)
+                else:
+                    if len(pending) >= workers:
+                        pending.popleft().result()
+                    pending.append(executor.submit(_sort_and_spill, buffer, run_path, key_spec, reverse))
+                buffer, used = [], 0
+            for future in pending:
+                future.result()
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        buffer.sort(key=key, reverse=reverse)
+        if not runs:
+            yield from buffer
+            return
+
+        while len(runs) >= _MAX_MERGE_FAN_IN:
+            merged_path = Path(temp) / f"run{len(runs)}_merged"
+            group, runs = runs[:_MAX_MERGE_FAN_IN], runs[_MAX_MERGE_FAN_IN:]
+            _write_run(merged_path, heapq.merge(*map(_read_run, group), key=key, reverse=reverse))
+            for run_path in group:
+                os.remove(run_path)
+            runs.insert(0, merged_path)
+
+        # the last, in-memory run comes last so equal keys keep file order
+        yield from heapq.merge(*map(_read_run, runs), buffer, key=key, reverse=reverse)
+
+
+def _make_sort_key(positions: List[int], numeric: bool) -> Callable[[List[str]], Any]:
+    if numeric:
+        if len(positions) == 1:
+            position = positions[0]
+            return lambda row: _numeric_key(row[position])
+        return lambda row: tuple(_numeric_key(row[i]) for i in positions)
+    return operator.itemgetter(*positions)
+
+
+def _numeric_key(value: str) -> Tuple[bool, float]:
+    # empty cells sort before every number
+    if not value.strip():
+        return False, 0.0
+    try:
+        return True, float(value)
+    except ValueError:
+        raise ValueError(f"cannot sort {value!r} numerically")
+
+
+def _estimate_row_size(row: List[str]) -> int:
+    # list object and pointers plus str object headers and contents
+    return 56 + 57 * len(row) + sum(map(len, row))
+
+
+def _sort_and_spill(rows: List[List[str]], run_path: Path, key_spec: Tuple[List[int], bool], reverse: bool) -> None:
+    rows.sort(key=_make_sort_key(*key_spec), reverse=reverse)
+    _write_run(run_path, rows)
+
+
+def _write_run(run_path: Path, rows: Iterable[List[str]]) -> None:
+    """
+    Spills rows to a run file as a sequence of pickled batches, which keeps
+    values byte for byte (unlike a csv round trip through universal newlines).
+    """
+    with open(run_path, "wb") as f:
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, _RUN_BATCH_ROWS))
+            if not batch:
+                break
+            pickle.dump(batch, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _read_run(run_path: Path) -> Generator[List[str], None, None]:
+    with open(run_path, "rb") as f:
+        while True:
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                return
+            yield from batch
+
+
+def _get_rows_cached(csvpath: PathLike, skip_header: bool, delimiter: str, encoding: str, cache_dir: PathLike, cache_max_bytes: int) -> Generator[List[str], None, None]:
+    """
+    Serves rows from a cache file holding length prefixed, marshalled batches
+    of parsed rows. Identical strings within a batch are stored once.
+    """
+    stat = os.stat(csvpath)
+    key = repr((os.path.abspath(csvpath), stat.st_size, stat.st_mtime_ns, delimiter, encoding, marshal.version, _ROW_CACHE_VERSION))
+    cache_path = Path(cache_dir) / (hashlib.sha1(key.encode("utf-8")).hexdigest() + ".rows")
+
+    try:
+        cache_file = open(cache_path, "rb")
+    except FileNotFoundError:
+        pass
+    else:
+        with cache_file:
+            # touch for the LRU eviction
+            os.utime(cache_path)
+            while True:
+                size = cache_file.read(8)
+                if not size:
+                    return
+                batch = marshal.loads(cache_file.read(int.from_bytes(size, "little")))
+                if skip_header:
+                    skip_header = False
+                    batch = batch[1:]
+                yield from batch
+
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_path = Path(str(cache_path) + f".{os.getpid()}.{threading.get_ident()}.tmp")
+    complete = False
+    try:
+        with open(temp_path, "wb") as cache_file:
+            rows = get_rows(csvpath, delimiter=delimiter, encoding=encoding)
+            while True:
+                batch = list(islice(rows, _ROW_CACHE_BATCH_ROWS))
+                if not batch:
+                    break
+                strings = {}
+                data = marshal.dumps([[strings.setdefault(value, value) for value in row] for row in batch])
+                cache_file.write(len(data).to_bytes(8, "little"))
+                cache_file.write(data)
+                if skip_header:
+                    skip_header = False
+                    batch = batch[1:]
+                yield from batch
+        os.replace(temp_path, cache_path)
+        complete = True
+    finally:
+        if not complete and temp_path.exists():
+            os.remove(temp_path)
+
+    _evict_row_cache(cache_dir, cache_max_bytes)
+
+
+def _evict_row_cache(cache_dir: PathLike, max_bytes: int) -> None:
+    entries = []
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if entry.name.endswith(".rows") and entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def join_csv(left_path: PathLike, right_path: PathLike, left_key: Union[int, str], right_key: Union[int, str], how="inner", out_path: PathLike = None, header=False, memory_limit=_SORT_MEMORY_LIMIT, delimiter=",", encoding="utf-8") -> Union[Path, Generator[List[str], None, None]]:
+    """
+    Joins two csv files on a key column with a hash join: one file is loaded
+    into a hash table on its key and the other is streamed through it.
+    For inner joins the smaller file is loaded, for left and anti joins the
+    right one. If the loaded side outgrows memory_limit both files are
+    partitioned on disk by key and joined partition by partition (grace hash
+    join), in which case rows come out grouped by partition rather than in
+    file order.
+
+    Example:
+        Adding customer names to orders::
+
+            >>> join_csv("orders.csv", "customers.csv", "customer_id", "id", how="left", out_path="enriched.csv", header=True)
+
+    Args:
+        left_path: Path to left csv file
+        right_path: Path to right csv file
+        left_key: Key column of the left file, as index or header name
+        right_key: Key column of the right file, as index or header name
+        how (str, optional): "inner" keeps matching pairs, "left" also keeps
+            unmatched left rows padded with empty strings, "anti" keeps only the left
+            rows without a match. Defaults to "inner".
+        out_path (optional): File to write the joined rows to. If not given a
+            generator of joined rows is returned instead.
+        header (bool, optional): Whether both files start with a header. The output
+            then starts with the combined header. Defaults to False.
+        memory_limit (int, optional): Approximate bytes the hash table may use before
+            spilling to disk. Defaults to 256 MB.
+        delimiter: Row delimiter character, default ","
+        encoding: File encoding, default "utf-8"
+
+    Returns:
+        out_path, or a generator of left row + right row lists (left row only for anti joins)
+    """
+    if how not in _JOIN_TYPES:
+        raise ValueError(f"unknown join type {how!r}, use one of {_JOIN_TYPES}")
+
+    rows = _joined_rows(left_path, right_path, left_key, right_key, how, header, memory_limit, delimiter, encoding)
+    if out_path is None:
+        return rows
+    return _write_rows_replacing(out_path, rows, delimiter, encoding)
+
+
+def _joined_rows(left_path: PathLike, right_path: PathLike, left_key: Union[int, str], right_key: Union[int, str], how: str, header: bool, memory_limit: int, delimiter: str, encoding: str) -> Generator[List[str], None, None]:
+    left_rows = get_rows(left_path, delimiter=delimiter, encoding=encoding)
+    right_rows = get_rows(right_path, delimiter=delimiter, encoding=encoding)
+    left_header = next(left_rows, None) if header else None
+    right_header = next(right_rows, None) if header else None
+    left_position = _column_position(left_key, left_header, "header")
+    right_position = _column_position(right_key, right_header, "header")
+    if header:
+        yield (left_header or []) + (right_header or [] if how != "anti" else [])
+
+    build_left = how == "inner" and os.path.getsize(left_path) < os.path.getsize(right_path)
+    if build_left:
+        build = (left_path, left_rows, left_position)
+        probe = (right_rows, right_position)
+    else:
+        build = (right_path, right_rows, right_position)
+        probe = (left_rows, left_position)
+    build_path, build_rows, build_position = build
+    probe_rows, probe_position = probe
+
+    # unmatched rows of a left join are padded to the width of the right file
+    pad = [""] * len(right_header) if right_header else None
+    table, used = {}, 0
+    for row in build_rows:
+        if pad is None:
+            pad = [""] * len(row)
+        table.setdefault(_join_key(row, build_position), []).append(row)
+        used += _estimate_row_size(row)
+        if used >= memory_limit:
+            break
+    else:
+        yield from _probe_table(table, probe_rows, probe_position, how, build_left, pad or [])
+        return
+
+    # grace hash join, everything read so far goes to the partitions as well
+    partitions = min(max(2, -(-os.path.getsize(build_path) * 4 // memory_limit)), _MAX_JOIN_PARTITIONS)
+    with TemporaryDirectory() as temp:
+        build_runs = _partition_rows(chain(chain.from_iterable(table.values()), build_rows), build_position, partitions, Path(temp) / "build")
+        table = None
+        probe_runs = _partition_rows(probe_rows, probe_position, partitions, Path(temp) / "probe")
+        for build_run, probe_run in zip(build_runs, probe_runs):
+            table = {}
+            for row in _read_run(build_run):
+                table.setdefault(_join_key(row, build_position), []).append(row)
+            yield from _probe_table(table, _read_run(probe_run), probe_position, how, build_left, pad)
+            os.remove(build_run)
+            os.remove(probe_run)
+
+
+def _join_key(row: List[str], position: int) -> str:
+    # short rows join on an empty key instead of failing
+    return row[position] if -len(row) <= position < len(row) else ""
+
+
+def _probe_table(table: Dict[str, List[List[str]]], probe_rows: Iterable[List[str]], probe_position: int, how: str, build_left: bool, pad: List[str]) -> Generator[List[str], None, None]:
+    for row in probe_rows:
+        matches = table.get(_join_key(row, probe_position))
+        if how == "anti":
+            if not matches:
+                yield row
+        elif matches:
+            for match in matches:
+                yield match + row if build_left else row + match
+        elif how == "left":
+            yield row + pad
+
+
+def _partition_rows(rows: Iterable[List[str]], position: int, partitions: int, prefix: Path) -> List[Path]:
+    """
+    Spreads rows over partition run files by a stable hash of their key.
+    """
+    paths = [Path(f"{prefix}{i}") for i in range(partitions)]
+    buffers = [[] for _ in range(partitions)]
+    files = [open(path, "wb") for path in paths]
+    try:
+        for row in rows:
+            i = zlib.crc32(_join_key(row, position).encode("utf-8")) % partitions
+            buffers[i].append(row)
+            if len(buffers[i]) >= _RUN_BATCH_ROWS:
+                pickle.dump(buffers[i], files[i], protocol=pickle.HIGHEST_PROTOCOL)
+                buffers[i] = []
+        for buffer, f in zip(buffers, files):
+            if buffer:
+                pickle.dump(buffer, f, protocol=pickle.HIGHEST_PROTOCOL)
+    finally:
+        for f in files:
+            f.close()
+    return paths
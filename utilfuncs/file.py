@@ -2,15 +2,52 @@ import os
 import shutil
 import datetime
 import base64
-import chardet
 import codecs
-from pathlib import Path
-from tempfile import TemporaryDirectory, tempdir
-from typing import List, Sequence, Union
-from zipfile import ZipFile, ZIP_DEFLATED
+import copy
+import fnmatch
+import hashlib
+import marshal
+import struct
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from chardet import UniversalDetector
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from pathlib import Path, PurePosixPath
+from tempfile import SpooledTemporaryFile, tempdir
+from typing import Any, BinaryIO, Callable, Dict, Generator, Iterable, List, Optional, Sequence, Tuple, Union
+from zipfile import ZipFile, ZipInfo, LargeZipFile, ZIP_DEFLATED, ZIP_STORED, ZIP64_LIMIT
 
 from utilfuncs.common import *
 
+# file types whose contents are already compressed, deflating them again wastes time
+STORED_SUFFIXES = frozenset({
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".lzma", ".7z", ".rar", ".zst",
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".mp3", ".mp4", ".mkv", ".mov", ".avi",
+    ".docx", ".xlsx", ".pptx", ".jar", ".whl",
+})
+_COPY_CHUNK_SIZE = 1024 * 1024
+_SPOOL_MAX_SIZE = 16 * 1024 * 1024
+_BASE64_CHUNK_SIZE = 3 * 1024 * 1024
+_DETECT_CHUNK_SIZE = 64 * 1024
+# utf-32 before utf-16, their little endian BOMs share a prefix
+_BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+_ENCODING_CACHE_SIZE = 4096
+_encoding_cache = OrderedDict()
+_encoding_cache_lock = threading.Lock()
+_HASH_BUFFER_SIZE = 1024 * 1024
+_PARTIAL_HASH_SIZE = 64 * 1024
+_SNAPSHOT_VERSION = 1
+
 
 def create_dir_if_not_exists(dirpath: PathLike) -> None:
     """
@@ -37,6 +74,110 @@ def get_base64_encoded_contents(filepath: PathLike) -> str:
         return base64.b64encode(f.read()).decode("utf-8")
 
 
+def iter_base64_encoded_chunks(filepath: PathLike, chunk_size=_BASE64_CHUNK_SIZE) -> Generator[bytes, None, None]:
+    """
+    Yields the b64 encoding of a file piece by piece. Joined together the pieces
+    equal get_base64_encoded_contents, while only one chunk is held in memory.
+
+    Args:
+        filepath: Path to file
+        chunk_size (int, optional): Bytes read per chunk, a multiple of 3 so chunks
+            encode without padding. Defaults to 3 MB.
+
+    Yields:
+        B64 encoded bytes
+    """
+    if chunk_size <= 0 or chunk_size % 3:
+        raise ValueError(f"chunk_size must be a positive multiple of 3, got {chunk_size}")
+
+    with open(filepath, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield base64.b64encode(chunk)
+
+
+def write_base64_encoded(filepath: PathLike, dest: Union[PathLike, Any], chunk_size=_BASE64_CHUNK_SIZE) -> int:
+    """
+    Streams the b64 encoding of a file to a destination file or object.
+
+    Args:
+        filepath: Path to file
+        dest: Path of the file to write, or an object with a write or sendall
+            method such as an open binary file or a socket
+        chunk_size (int, optional): See iter_base64_encoded_chunks. Defaults to 3 MB.
+
+    Returns:
+        Number of encoded bytes written
+    """
+    written = 0
+    with _binary_writer(dest) as write:
+        for encoded in iter_base64_encoded_chunks(filepath, chunk_size):
+            write(encoded)
+            written += len(encoded)
+    return written
+
+
+def write_base64_decoded(src: Union[PathLike, Any], dest: Union[PathLike, Any], chunk_size=4 * 1024 * 1024) -> int:
+    """
+    Streams b64 encoded data back to its original bytes. Whitespace and line
+    breaks in the input are ignored.
+
+    Args:
+        src: Path of a file holding b64 text, or a readable file-like object
+            returning bytes or str
+        dest: Path of the file to write, or an object with a write or sendall method
+        chunk_size (int, optional): Characters read at a time. Defaults to 4 MB.
+
+    Returns:
+        Number of decoded bytes written
+    """
+    written = 0
+    pending = b""
+    with _binary_reader(src) as read, _binary_writer(dest) as write:
+        while True:
+            chunk = read(chunk_size)
+            if isinstance(chunk, str):
+                chunk = chunk.encode("ascii")
+            if not chunk:
+                break
+            pending += b"".join(chunk.split())
+            usable = len(pending) - len(pending) % 4
+            decoded = base64.b64decode(pending[:usable], validate=True)
+            pending = pending[usable:]
+            write(decoded)
+            written += len(decoded)
+    if pending:
+        raise ValueError(f"b64 input is truncated, {len(pending)} characters left over")
+    return written
+
+
+@contextmanager
+def _binary_writer(dest: Union[PathLike, Any]) -> Generator[Callable[[bytes], Any], None, None]:
+    """
+    Gives a write function for a path (opened and closed here) or for a
+    file-like or socket-like object (left open).
+    """
+    if isinstance(dest, (str, os.PathLike)):
+        with open(dest, "wb") as f:
+            yield f.write
+    else:
+        yield getattr(dest, "sendall", None) or dest.write
+
+
+@contextmanager
+def _binary_reader(src: Union[PathLike, Any]) -> Generator[Callable[[int], Union[bytes, str]], None, None]:
+    """
+    Gives a read function for a path or a file-like object.
+    """
+    if isinstance(src, (str, os.PathLike)):
+        with open(src, "rb") as f:
+            yield f.read
+    else:
+        yield src.read
+
+
 def get_ext(filepath: PathLike) -> str:
     """
     Returns the extension of the file with prepended period (.)
@@ -108,6 +249,111 @@ def move_files(src_dir: PathLike, dest_dir: PathLike, ext="") -> None:
             move_file(filepath, dest_dir)
 
 
+def bulk_move_files(src_dir: PathLike, dest_dir: PathLike, ext="", pattern: str = None, workers: int = None) -> Dict[str, Any]:
+    """
+    Moves many files from src to dest, non recursively, like move_files or
+    move_files_matching_regex but built for large batches. The source is
+    scanned once, files on the destination's filesystem are renamed in place
+    and the others are copied with kernel side copies (copy_file_range or
+    sendfile where available), in parallel, before their source is removed.
+    Existing files in dest are replaced. Failures are reported, not raised.
+
+    Args:
+        src_dir: Source directory containing files to move
+        dest_dir: Destination directory
+        ext (str, optional): Only move files ending with this extension. Defaults to "".
+        pattern (str, optional): Only move files whose name matches this glob pattern
+        workers (int, optional): Number of threads copying across filesystems. Defaults to None.
+
+    Returns:
+        Summary dictionary with "moved", "renamed", "copied", "bytes" and "failed",
+        a list of (path, error) pairs
+    """
+    dest = Path(dest_dir)
+    dest_device = os.stat(dest).st_dev
+    renames, copies = [], []
+    for entry in iter_files(src_dir, ext or None, pattern=pattern, max_depth=0):
+        stat = entry.stat()
+        (renames if stat.st_dev == dest_device else copies).append((Path(entry.path), stat.st_size))
+
+    summary = {"moved": 0, "renamed": 0, "copied": 0, "bytes": 0, "failed": []}
+
+    def record(path: Path, size: int, kind: str, error: Optional[str]) -> None:
+        if error is None:
+            summary["moved"] += 1
+            summary[kind] += 1
+            summary["bytes"] += size
+        else:
+            summary["failed"].append((path, error))
+
+    for path, size in renames:
+        try:
+            os.replace(path, dest / path.name)
+            record(path, size, "renamed", None)
+        except OSError as e:
+            record(path, size, "renamed", str(e))
+
+    def copy_then_unlink(item: Tuple[Path, int]) -> Optional[str]:
+        path = item[0]
+        target = dest / path.name
+        partial = dest / (path.name + ".part")
+        try:
+            _copy_file_fast(path, partial)
+            os.replace(partial, target)
+            os.remove(path)
+        except OSError as e:
+            if partial.exists():
+                os.remove(partial)
+            return str(e)
+        return None
+
+    if workers is None or workers <= 1:
+        errors = list(map(copy_then_unlink, copies))
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            errors = list(executor.map(copy_then_unlink, copies))
+    for (path, size), error in zip(copies, errors):
+        record(path, size, "copied", error)
+
+    return summary
+
+
+def _copy_file_fast(src: PathLike, dst: PathLike) -> None:
+    """
+    Copies a file's data inside the kernel when the platform allows it, with
+    copy_file_range, then sendfile, then a buffered copy, and copies its
+    metadata like shutil.copy2.
+    """
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+        size = os.fstat(src_fd).st_size
+        copied = 0
+        if hasattr(os, "copy_file_range"):
+            try:
+                while copied < size:
+                    n = os.copy_file_range(src_fd, dst_fd, size - copied, copied, copied)
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError:
+                pass
+        if copied < size and hasattr(os, "sendfile"):
+            try:
+                os.lseek(dst_fd, copied, os.SEEK_SET)
+                while copied < size:
+                    n = os.sendfile(dst_fd, src_fd, copied, size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError:
+                pass
+        if copied < size:
+            fsrc.seek(copied)
+            fdst.seek(copied)
+            shutil.copyfileobj(fsrc, fdst, _COPY_CHUNK_SIZE)
+    shutil.copystat(src, dst)
+
+
 def move_dir(src: PathLike, dest: PathLike) -> PathLike:
     """
     Moves dir from source to destination and returns new dir path.
@@ -141,9 +387,10 @@ def move_files_matching_regex(src_dir: PathLike, dest_dir: PathLike, pattern: st
         move_file(path, dest_dir)
 
 
-def zipdir(dirpath: PathLike, zip_path: PathLike = None, delete_dir_afterwards=False, top_level_dir=True) -> Path:
+def zipdir(dirpath: PathLike, zip_path: PathLike = None, delete_dir_afterwards=False, top_level_dir=True, workers: int = None, compresslevel: int = None, store_compressed_types=True, incremental=False, verify_crc=False) -> Path:
     """
     Creates a zip archive which contains the directory specified in dirPath.
+    ZIP64 extensions are used when the archive or a member needs them.
 
     Args:
         dirpath: Path to directory
@@ -154,6 +401,20 @@ def zipdir(dirpath: PathLike, zip_path: PathLike = None, delete_dir_afterwards=F
             after compression. Defaults to False.
         top_level_dir (bool, optional): Whether to have dirpath folder
             inside the zip or to have dirpath files directly inside the zip. Defaults to True.
+        workers (int, optional): Number of threads deflating files in parallel. The
+            compressed members are still written one after the other, so the result
+            is a standard zip. Defaults to None, compressing on this thread.
+        compresslevel (int, optional): Deflate level from 0 to 9. Defaults to zlib's default.
+        store_compressed_types (bool, optional): Whether to store files with an
+            extension in STORED_SUFFIXES (archives, images, video...) without
+            compressing them again. Defaults to True.
+        incremental (bool, optional): If the zip file already exists, only compress
+            new and modified files. Unchanged members (same size and modification
+            time, or same CRC) are copied over without recompressing and members of
+            deleted files are dropped. The updated archive replaces the old one
+            atomically. Defaults to False.
+        verify_crc (bool, optional): With incremental, also compare the CRC of
+            files whose size and modification time are unchanged. Defaults to False.
 
     Returns:
         Path of compressed zip file
@@ -165,10 +426,13 @@ def zipdir(dirpath: PathLike, zip_path: PathLike = None, delete_dir_afterwards=F
     resolved_path = Path(dirpath).expanduser().resolve(strict=True)
 
     final_zip_path = zip_path if zip_path is not None else (resolved_path.parent / (resolved_path.name + ".zip"))
-    with ZipFile(final_zip_path, "w", ZIP_DEFLATED) as zf:
-        for path in resolved_path.rglob("*"):
-            rel_to_top_level = path.relative_to(resolved_path.parent) if top_level_dir else path.relative_to(resolved_path)
-            zf.write(path, rel_to_top_level)
+    base = resolved_path.parent if top_level_dir else resolved_path
+    members = ((path, path.relative_to(base)) for path in resolved_path.rglob("*"))
+    if incremental and Path(final_zip_path).is_file():
+        _update_zip(final_zip_path, members, workers, compresslevel, store_compressed_types, verify_crc)
+    else:
+        with ZipFile(final_zip_path, "w", ZIP_DEFLATED, compresslevel=compresslevel) as zf:
+            _write_members(zf, members, workers, compresslevel, store_compressed_types)
     
     if delete_dir_afterwards:
         shutil.rmtree(str(dirpath))
@@ -176,74 +440,604 @@ def zipdir(dirpath: PathLike, zip_path: PathLike = None, delete_dir_afterwards=F
     return final_zip_path
 
 
-def zipfiles(zip_path: PathLike, files_or_directories: Sequence[PathLike]) -> None:
+def zipfiles(zip_path: PathLike, files_or_directories: Sequence[PathLike], workers: int = None, compresslevel: int = None, store_compressed_types=True, on_conflict="last") -> None:
     """
     Creates a zip archive from list of file or directory paths in destination.
+    Files are stored under their name and directories under their name with
+    their whole tree, all at the top level of the archive. Nothing is copied
+    to disk beforehand.
 
     Args:
         zip_path: Path of zip file with proper name and extension
-        file_paths: List of Paths
+        files_or_directories: List of Paths
+        workers (int, optional): Number of threads deflating files, see zipdir.
+        compresslevel (int, optional): Deflate level from 0 to 9, see zipdir.
+        store_compressed_types (bool, optional): See zipdir. Defaults to True.
+        on_conflict (str, optional): What to do when two inputs map to the same name
+            in the archive: "last" keeps the later input, "first" keeps the earlier
+            one and "error" raises FileExistsError. Directories with the same name
+            are merged. Defaults to "last".
     """
-    with TemporaryDirectory() as temp:
+    if on_conflict not in ("first", "last", "error"):
+        raise ValueError(f"on_conflict must be 'first', 'last' or 'error', not {on_conflict!r}")
 
-        for f in files_or_directories:
-            if Path(f).is_dir():
-                shutil.copytree(f, Path(temp) / f.name)
-            else:
-                shutil.copyfile(f, Path(temp) / f.name)
+    members = {}
+    for f in map(Path, files_or_directories):
+        entries = [(f, f.name)]
+        if f.is_dir():
+            entries += [(path, (Path(f.name) / path.relative_to(f)).as_posix()) for path in f.rglob("*")]
+        for path, arcname in entries:
+            existing = members.get(arcname)
+            if existing is not None and not (existing.is_dir() and path.is_dir()):
+                if on_conflict == "error":
+                    raise FileExistsError(f"{path} and {existing} would both be stored as {arcname}")
+                if on_conflict == "first":
+                    continue
+            members[arcname] = path
+
+    with ZipFile(zip_path, "w", ZIP_DEFLATED, compresslevel=compresslevel) as zf:
+        _write_members(zf, ((path, arcname) for arcname, path in members.items()), workers, compresslevel, store_compressed_types)
+
+
+def _update_zip(zip_path: PathLike, members: Iterable[Tuple[Path, PathLike]], workers: int, compresslevel: int, store_compressed_types: bool, verify_crc: bool) -> None:
+    """
+    Rewrites an archive from members, copying the compressed bytes of
+    unchanged files from the existing archive.
+    """
+    temp_path = Path(str(zip_path) + ".tmp")
+    try:
+        with ZipFile(zip_path, "r") as old, open(zip_path, "rb") as old_fp:
+            old_infos = {info.filename: info for info in old.infolist()}
+            with ZipFile(temp_path, "w", ZIP_DEFLATED, compresslevel=compresslevel) as zf:
+                changed = []
+                for path, arcname in members:
+                    info = old_infos.get(Path(arcname).as_posix())
+                    if info is not None and path.is_file() and _is_unchanged(path, info, verify_crc):
+                        _copy_raw_member(old_fp, info, zf)
+                    else:
+                        changed.append((path, arcname))
+                _write_members(zf, changed, workers, compresslevel, store_compressed_types)
+        os.replace(temp_path, zip_path)
+    finally:
+        if temp_path.exists():
+            os.remove(temp_path)
+
+
+def _is_unchanged(path: Path, info: ZipInfo, verify_crc: bool) -> bool:
+    if info.flag_bits & 0x01:
+        # encrypted members can't be compared
+        return False
+    stat = path.stat()
+    if stat.st_size != info.file_size:
+        return False
+    # zip files store DOS times, which round the seconds down to an even number
+    date_time = time.localtime(stat.st_mtime)[:6]
+    if not verify_crc and date_time[:5] + (date_time[5] // 2 * 2,) == info.date_time:
+        return True
+    return _crc32_of(path) == info.CRC
 
-        zipdir(temp, zip_path, top_level_dir=False)
 
+def _crc32_of(path: Path) -> int:
+    crc = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(_COPY_CHUNK_SIZE)
+            if not chunk:
+                return crc
+            crc = zlib.crc32(chunk, crc)
 
-def get_contents_as_utf8(filepath: PathLike) -> str:
+
+def _copy_raw_member(old_fp: BinaryIO, info: ZipInfo, zf: ZipFile) -> None:
+    """
+    Copies a member's compressed bytes from another archive without
+    decompressing them.
+    """
+    old_fp.seek(info.header_offset)
+    header = old_fp.read(30)
+    if header[:4] != b"PK\x03\x04":
+        raise ValueError(f"bad local file header for {info.filename}")
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    old_fp.seek(info.header_offset + 30 + name_length + extra_length)
+
+    new_info = copy.copy(info)
+    # FileHeader adds its own zip64 field when needed
+    new_info.extra = _strip_extra_field(info.extra, 0x0001)
+    _write_precompressed(zf, new_info, old_fp)
+
+
+def _strip_extra_field(extra: bytes, field_id: int) -> bytes:
+    kept = []
+    i = 0
+    while i + 4 <= len(extra):
+        xid, xlen = struct.unpack("<HH", extra[i:i + 4])
+        if xid != field_id:
+            kept.append(extra[i:i + 4 + xlen])
+        i += 4 + xlen
+    return b"".join(kept)
+
+
+def _write_members(zf: ZipFile, members: Iterable[Tuple[Path, PathLike]], workers: int = None, compresslevel: int = None, store_compressed_types=True) -> None:
+    """
+    Writes (path, arcname) pairs to an open zip file in order. With workers,
+    files are deflated ahead in a thread pool (zlib releases the GIL) while
+    finished members are appended to the archive.
+    """
+    def compress_type(path: Path) -> int:
+        return ZIP_STORED if store_compressed_types and path.suffix.lower() in STORED_SUFFIXES else ZIP_DEFLATED
+
+    if workers is None or workers <= 1:
+        for path, arcname in members:
+            zf.write(path, arcname, compress_type=compress_type(path), compresslevel=compresslevel)
+        return
+
+    def write_next(pending: deque) -> None:
+        path, arcname, future = pending.popleft()
+        if future is None:
+            zf.write(path, arcname, compress_type=compress_type(path), compresslevel=compresslevel)
+            return
+        zinfo, data = future.result()
+        with data:
+            _write_precompressed(zf, zinfo, data)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for path, arcname in members:
+            # directories and stored files are cheap, they are written in turn
+            deflate = path.is_file() and compress_type(path) == ZIP_DEFLATED
+            future = executor.submit(_deflate_file, path, arcname, compresslevel) if deflate else None
+            pending.append((path, arcname, future))
+            # bound the number of compressed members waiting in memory/spool files
+            if len(pending) >= workers * 2:
+                write_next(pending)
+        while pending:
+            write_next(pending)
+
+
+def _deflate_file(path: Path, arcname: PathLike, compresslevel: int = None) -> Tuple[ZipInfo, BinaryIO]:
+    """
+    Deflates a file into a spooled temporary file, returning the ZipInfo
+    describing it and the compressed data positioned at its start.
+    """
+    zinfo = ZipInfo.from_file(path, arcname)
+    zinfo.compress_type = ZIP_DEFLATED
+    level = zlib.Z_DEFAULT_COMPRESSION if compresslevel is None else compresslevel
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    data = SpooledTemporaryFile(max_size=_SPOOL_MAX_SIZE)
+    crc = size = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(_COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            data.write(compressor.compress(chunk))
+        data.write(compressor.flush())
+    zinfo.file_size = size
+    zinfo.CRC = crc
+    zinfo.compress_size = data.tell()
+    data.seek(0)
+    return zinfo, data
+
+
+def _write_precompressed(zf: ZipFile, zinfo: ZipInfo, data: BinaryIO) -> None:
+    """
+    Appends a member whose compressed bytes, CRC and sizes are already known,
+    reading compress_size bytes from data.
+    zipfile has no public API for this, so this mirrors what ZipFile.open(mode="w")
+    does while writing the raw bytes as they are.
+    """
+    zip64 = zinfo.file_size > ZIP64_LIMIT or zinfo.compress_size > ZIP64_LIMIT
+    if zip64 and not zf._allowZip64:
+        raise LargeZipFile("Filesize would require ZIP64 extensions")
+    zinfo.flag_bits &= ~0x08  # sizes are in the header, no data descriptor follows
+    if not zinfo.external_attr:
+        zinfo.external_attr = 0o600 << 16
+
+    with zf._lock:
+        if zf._seekable:
+            zf.fp.seek(zf.start_dir)
+        zinfo.header_offset = zf.fp.tell()
+        zf._writecheck(zinfo)
+        zf._didModify = True
+        zf.fp.write(zinfo.FileHeader(zip64))
+        remaining = zinfo.compress_size
+        while remaining > 0:
+            chunk = data.read(min(_COPY_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise EOFError(f"compressed data of {zinfo.filename} is truncated")
+            zf.fp.write(chunk)
+            remaining -= len(chunk)
+        zf.start_dir = zf.fp.tell()
+        zf.filelist.append(zinfo)
+        zf.NameToInfo[zinfo.filename] = zinfo
+
+
+def unzip(zip_path: PathLike, dest_dir: PathLike, pattern: str = None, workers: int = None, skip_unchanged=True) -> List[Path]:
+    """
+    Extracts a zip archive into a directory, streaming each member in
+    fixed size blocks so memory use stays bounded.
+    All member paths are checked before anything is written, an archive with
+    a member that would land outside dest_dir (zip slip) raises
+    UnsafeArchiveMember.
+
+    Args:
+        zip_path: Path to zip file
+        dest_dir: Directory to extract into, created if missing
+        pattern (str, optional): Glob pattern like in move_files_matching_regex,
+            matched against member paths from the right (ex "*.log" or "logs/*_error_*").
+            Defaults to all members.
+        workers (int, optional): Number of threads extracting members in parallel,
+            each with its own handle on the archive. Defaults to None.
+        skip_unchanged (bool, optional): Leave files alone whose size and CRC already
+            match the member. Defaults to True.
+
+    Returns:
+        List of paths of the files written
+    """
+    dest = Path(dest_dir).expanduser()
+    dest.mkdir(parents=True, exist_ok=True)
+    dest = dest.resolve()
+
+    with ZipFile(zip_path, "r") as zf:
+        infos = [info for info in zf.infolist() if pattern is None or PurePosixPath(info.filename).match(pattern)]
+    targets = [(info, _safe_extract_target(dest, info.filename)) for info in infos]
+
+    files = []
+    for info, target in targets:
+        if info.is_dir():
+            target.mkdir(parents=True, exist_ok=True)
+        else:
+            files.append((info, target))
+
+    handles = threading.local()
+    opened = []
+    lock = threading.Lock()
+
+    def extract(info: ZipInfo, target: Path) -> Path:
+        if skip_unchanged and target.is_file() and target.stat().st_size == info.file_size and _crc32_of(target) == info.CRC:
+            return None
+        zf = getattr(handles, "zf", None)
+        if zf is None:
+            zf = handles.zf = ZipFile(zip_path, "r")
+            with lock:
+                opened.append(zf)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with zf.open(info) as src, open(target, "wb") as dst:
+            shutil.copyfileobj(src, dst, _COPY_CHUNK_SIZE)
+        return target
+
+    try:
+        if workers is None or workers <= 1:
+            written = [extract(info, target) for info, target in files]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                written = list(executor.map(lambda member: extract(*member), files))
+    finally:
+        for zf in opened:
+            zf.close()
+
+    return [path for path in written if path is not None]
+
+
+def _safe_extract_target(dest: Path, member_name: str) -> Path:
+    target = (dest / member_name).resolve()
+    if target != dest and dest not in target.parents:
+        raise UnsafeArchiveMember(f"{member_name} would be extracted outside of {dest}")
+    return target
+
+
+def detect_encoding(filepath: PathLike, use_cache=True) -> Optional[str]:
     """
-    Returns a string representing contents of the file converted to
-    utf-8.
+    Detects the text encoding of a file without reading more than needed:
+    a byte order mark decides right away, then a strict utf-8 decode is tried
+    (utf-8 files are read once, at C speed), and otherwise chardet's
+    UniversalDetector is fed blocks until it is confident.
+    The last 4096 results are cached by path, size and modification time.
 
     Args:
         filepath: Path to file
+        use_cache (bool, optional): Whether to use and fill the cache. Defaults to True.
 
     Returns:
-        File content as utf-8 string
+        Codec name usable with codecs/open, or None if no guess could be made
     """
+    stat = os.stat(filepath)
+    key = (os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns)
+    if use_cache:
+        with _encoding_cache_lock:
+            if key in _encoding_cache:
+                _encoding_cache.move_to_end(key)
+                return _encoding_cache[key]
+
+    with open(filepath, "rb") as f:
+        encoding = _detect_open_file_encoding(f)
+
+    if use_cache:
+        with _encoding_cache_lock:
+            _encoding_cache[key] = encoding
+            # least recently used entries go first, long-lived processes see many files
+            if len(_encoding_cache) > _ENCODING_CACHE_SIZE:
+                _encoding_cache.popitem(last=False)
+    return encoding
+
+
+def _detect_open_file_encoding(f: BinaryIO) -> Optional[str]:
+    head = f.read(4)
+    for bom, encoding in _BOMS:
+        if head.startswith(bom):
+            return encoding
+
+    f.seek(0)
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    try:
+        while True:
+            chunk = f.read(_DETECT_CHUNK_SIZE)
+            if not chunk:
+                break
+            decoder.decode(chunk)
+        decoder.decode(b"", final=True)
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+
+    f.seek(0)
+    detector = UniversalDetector()
+    while not detector.done:
+        chunk = f.read(_DETECT_CHUNK_SIZE)
+        if not chunk:
+            break
+        detector.feed(chunk)
+    detector.close()
+    return detector.result["encoding"]
+
+
+def get_contents_as_utf8(filepath: PathLike) -> bytes:
+    """
+    Returns the contents of the file converted to utf-8.
+    The encoding is found with detect_encoding.
+
+    Args:
+        filepath: Path to file
+
+    Returns:
+        File content as utf-8 encoded bytes
+    """
+    file_encoding = detect_encoding(filepath)
     with open(filepath, "rb") as f:
         content_bytes = f.read()
-        detected = chardet.detect(content_bytes)
-        file_encoding = detected["encoding"]
-        # print(f"{filepath}: detected as {file_encoding}."
-        if "utf-8" in file_encoding.lower():
-            return filepath
-        elif file_encoding is None:
-            content_text = codecs.decode(content_bytes)
-        else:
-            content_text = codecs.decode(content_bytes, file_encoding, errors="replace")
+
+    if file_encoding == "utf-8":
+        return content_bytes
+    elif file_encoding is None:
+        content_text = codecs.decode(content_bytes)
+    else:
+        content_text = codecs.decode(content_bytes, file_encoding, errors="replace")
 
     return codecs.encode(content_text, "utf-8", errors="replace")
 
 
-def all_files_under(dirpath: PathLike, extension="") -> List[Path]:
+def transcode_to_utf8(filepath: PathLike, dest_path: PathLike = None, chunk_size=1024 * 1024) -> Path:
     """
-    Iterates through all files that are under the given dir with the given extension ex '.log'
+    Converts a file to utf-8 in a streaming fashion, so it never sits in
+    memory as a whole. The output is written to a temporary file which then
+    atomically replaces dest_path.
 
     Args:
-        path: The directory to scan
-        extension (str, optional): The extensions to consider if provided (with period)
+        filepath: Path to file
+        dest_path (optional): Path to write the utf-8 file to. Defaults to
+            converting filepath in place.
+        chunk_size (int, optional): Bytes read at a time. Defaults to 1 MB.
+
     Returns:
-        List of Path objects or empty list if no files in directory
+        Path of the utf-8 file
+
+    Raises:
+        UndetectedEncoding: No encoding could be detected, the file is left as is
     """
-    results = []
+    dest_path = Path(dest_path if dest_path is not None else filepath)
+    encoding = detect_encoding(filepath)
+    if encoding is None:
+        # guessing would replace every undecodable byte, destroying binary files
+        raise UndetectedEncoding(f"could not detect the encoding of {filepath}")
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    temp_path = dest_path.with_name(dest_path.name + ".utf8.tmp")
+    try:
+        with open(filepath, "rb") as src, open(temp_path, "wb") as dst:
+            while True:
+                chunk = src.read(chunk_size)
+                dst.write(decoder.decode(chunk, final=not chunk).encode("utf-8", errors="replace"))
+                if not chunk:
+                    break
+        shutil.copymode(filepath, temp_path)
+        os.replace(temp_path, dest_path)
+    finally:
+        if temp_path.exists():
+            os.remove(temp_path)
+    return dest_path
+
+
+def transcode_dir_to_utf8(dirpath: PathLike, extension="", dest_dir: PathLike = None, workers: int = None, skip_utf8=True) -> Dict[str, Any]:
+    """
+    Converts the files of a directory (as listed by all_files_under) to utf-8,
+    detecting and converting them in a process pool. Each output file is
+    written atomically.
+
+    Args:
+        dirpath: Directory holding the files
+        extension (str, optional): Only convert files with this extension (with period)
+        dest_dir (optional): Directory to write the converted files to, under the
+            same names. Defaults to converting the files in place.
+        workers (int, optional): Number of processes. Defaults to None, converting
+            in this process.
+        skip_utf8 (bool, optional): Leave files detected as utf-8 untouched (they are
+            only copied when dest_dir is given). Defaults to True.
 
+    Returns:
+        Report dictionary with a "files" list of per file results (path, dest,
+        encoding, status of "transcoded", "skipped", "copied" or "failed", bytes,
+        seconds, error) and the totals "transcoded", "skipped", "copied",
+        "failed", "bytes", "seconds" and "mb_per_second". Files whose encoding
+        can't be detected, such as binary files, fail and are left untouched.
+    """
+    start = time.perf_counter()
+    files = all_files_under(dirpath, extension)
+    if dest_dir is not None:
+        create_dir_if_not_exists(Path(dest_dir))
+    dests = [Path(dest_dir) / f.name if dest_dir is not None else f for f in files]
+    skips = [skip_utf8] * len(files)
+
+    if workers is None or workers <= 1:
+        results = list(map(_transcode_file, files, dests, skips))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_transcode_file, files, dests, skips, chunksize=16))
+
+    seconds = time.perf_counter() - start
+    total_bytes = sum(result["bytes"] for result in results)
+    report = {status: sum(1 for result in results if result["status"] == status) for status in ("transcoded", "skipped", "copied", "failed")}
+    report.update({
+        "files": results,
+        "bytes": total_bytes,
+        "seconds": seconds,
+        "mb_per_second": total_bytes / (1024 * 1024) / seconds if seconds else 0.0,
+    })
+    return report
+
+
+def _transcode_file(path: Path, dest: Path, skip_utf8: bool) -> Dict[str, Any]:
+    start = time.perf_counter()
+    result = {"path": path, "dest": dest, "encoding": None, "status": None, "bytes": 0, "seconds": 0.0, "error": None}
     try:
-        currpath, _, filenames = next(os.walk(dirpath))  # only traverse one level
-    except StopIteration:
-        # means no files in log folder
-        return results
+        result["bytes"] = path.stat().st_size
+        result["encoding"] = detect_encoding(path)
+        if skip_utf8 and result["encoding"] in ("utf-8", "ascii"):
+            if dest == path:
+                result["status"] = "skipped"
+            else:
+                temp_path = dest.with_name(dest.name + ".utf8.tmp")
+                shutil.copy2(path, temp_path)
+                os.replace(temp_path, dest)
+                result["status"] = "copied"
+        else:
+            transcode_to_utf8(path, dest)
+            result["status"] = "transcoded"
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = str(e)
+    result["seconds"] = time.perf_counter() - start
+    return result
 
-    for name in filenames:
-        if extension in name:  # empty string extension will match all files
-            results.append(Path(currpath) / name)
 
-    return results
+def iter_files(dirpath: PathLike, extensions: Union[str, Sequence[str]] = None, pattern: str = None, min_size: int = None, max_size: int = None, modified_after: Union[datetime.datetime, float] = None, modified_before: Union[datetime.datetime, float] = None, max_depth: int = None, workers: int = None) -> Generator[os.DirEntry, None, None]:
+    """
+    Lazily yields the files under a directory, recursively, as os.DirEntry
+    objects. Their stat() result is cached, so callers and the size and time
+    filters share a single stat per file. Directories which can't be read are
+    skipped, like os.walk does.
+
+    Example:
+        Large logs of the last week::
+
+            >>> week_ago = datetime.datetime.now() - datetime.timedelta(days=7)
+            >>> [entry.path for entry in iter_files("logs", ".log", min_size=10**6, modified_after=week_ago)]
+
+    Args:
+        dirpath: The directory to scan
+        extensions (optional): Extension or extensions (with period) the file names
+            must end with
+        pattern (str, optional): Glob pattern the file names must match, ex "*_error_*"
+        min_size (int, optional): Minimum size in bytes
+        max_size (int, optional): Maximum size in bytes
+        modified_after (optional): Only files modified at or after this datetime or timestamp
+        modified_before (optional): Only files modified before this datetime or timestamp
+        max_depth (int, optional): How many directory levels to descend, 0 only lists
+            dirpath itself. Defaults to no limit.
+        workers (int, optional): Number of threads scanning directories in parallel,
+            files then come in no particular order. Defaults to None.
+
+    Yields:
+        os.DirEntry of each matching file
+    """
+    if isinstance(extensions, str):
+        extensions = (extensions,)
+    extensions = tuple(extensions) if extensions else None
+    after = modified_after.timestamp() if isinstance(modified_after, datetime.datetime) else modified_after
+    before = modified_before.timestamp() if isinstance(modified_before, datetime.datetime) else modified_before
+    needs_stat = any(limit is not None for limit in (min_size, max_size, after, before))
+
+    def matches(entry: os.DirEntry) -> bool:
+        if extensions is not None and not entry.name.endswith(extensions):
+            return False
+        if pattern is not None and not fnmatch.fnmatchcase(entry.name, pattern):
+            return False
+        if needs_stat:
+            stat = entry.stat()
+            if min_size is not None and stat.st_size < min_size:
+                return False
+            if max_size is not None and stat.st_size > max_size:
+                return False
+            if after is not None and stat.st_mtime < after:
+                return False
+            if before is not None and stat.st_mtime >= before:
+                return False
+        return True
+
+    if workers is None or workers <= 1:
+        stack = [(os.fspath(dirpath), 0)]
+        while stack:
+            path, depth = stack.pop()
+            files, subdirs = _scan_dir(path)
+            yield from filter(matches, files)
+            if max_depth is None or depth < max_depth:
+                stack.extend((subdir, depth + 1) for subdir in reversed(subdirs))
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(_scan_dir, os.fspath(dirpath)): 0}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                depth = pending.pop(future)
+                files, subdirs = future.result()
+                if max_depth is None or depth < max_depth:
+                    for subdir in subdirs:
+                        pending[executor.submit(_scan_dir, subdir)] = depth + 1
+                yield from filter(matches, files)
+
+
+def _scan_dir(path: str) -> Tuple[List[os.DirEntry], List[str]]:
+    """
+    Returns the file entries and subdirectory paths of one directory.
+    """
+    files, subdirs = [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file():
+                        files.append(entry)
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return files, subdirs
+
+
+def all_files_under(dirpath: PathLike, extension="") -> List[Path]:
+    """
+    Iterates through all files that are under the given dir with the given extension ex '.log'
+    Non recursive, see iter_files for recursive and filtered scans.
+
+    Args:
+        path: The directory to scan
+        extension (str, optional): The extension the file names must end with if provided (with period)
+    Returns:
+        List of Path objects or empty list if no files in directory
+    """
+    return [Path(entry.path) for entry in iter_files(dirpath, extension or None, max_depth=0)]
 
 
 def delete_old_files(dirpath: PathLike, days: int, extension="") -> List[Path]:
@@ -263,14 +1057,386 @@ def delete_old_files(dirpath: PathLike, days: int, extension="") -> List[Path]:
     num_days = -1 * days
     days_ago = datetime.datetime.now() + datetime.timedelta(num_days)
 
-    filepaths = all_files_under(dirpath, extension)
-
     deleted = []
 
-    for f in filepaths:
-        last_m_time = datetime.datetime.fromtimestamp(f.stat().st_mtime)
-        if last_m_time < days_ago:
-            os.remove(f)
-            deleted.append(f)
+    for entry in iter_files(dirpath, extension or None, modified_before=days_ago, max_depth=0):
+        os.remove(entry.path)
+        deleted.append(Path(entry.path))
     
     return deleted
+
+
+def apply_retention(dirpath: PathLike, max_age_days: float = None, keep_newest: int = None, max_total_bytes: int = None, extensions: Union[str, Sequence[str]] = None, pattern: str = None, recursive=True, dry_run=False, workers: int = None, archive_path: PathLike = None) -> Dict[str, Any]:
+    """
+    Deletes files under a directory according to retention policies, scanning
+    it once with a single stat per file. A file is deleted if any policy says
+    so: it is older than max_age_days, it is not among the keep_newest newest
+    files, or keeping it would push the newest files kept past max_total_bytes.
+
+    Example:
+        Keep a week of logs, at most 10 GB::
+
+            >>> apply_retention("logs", max_age_days=7, max_total_bytes=10 * 1024**3, extensions=".log")
+
+    Args:
+        dirpath: Path for directory
+        max_age_days (float, optional): Delete files last modified longer ago than this
+        keep_newest (int, optional): Delete all but this many most recently modified files
+        max_total_bytes (int, optional): Delete the oldest files beyond this total size
+        extensions (optional): Only consider files with this extension or extensions
+        pattern (str, optional): Only consider files whose name matches this glob pattern
+        recursive (bool, optional): Whether to scan subdirectories. Defaults to True.
+        dry_run (bool, optional): Only plan, don't archive or delete. Defaults to False.
+        workers (int, optional): Number of threads used to scan, compress the archive
+            and delete. Defaults to None.
+        archive_path (optional): Zip file the deleted files are added to first,
+            under their path relative to dirpath. An existing archive is appended
+            to and replaced atomically. Nothing is deleted if it fails.
+
+    Returns:
+        Report dictionary with "planned" and "deleted" lists of paths, "failed"
+        (path, error) pairs, "bytes_freed", "scanned", "kept", "dry_run" and "archive"
+    """
+    archive_name = Path(archive_path).name if archive_path is not None else None
+    archive_abspath = os.path.abspath(archive_path) if archive_path is not None else None
+    entries = []
+    for entry in iter_files(dirpath, extensions, pattern=pattern, max_depth=None if recursive else 0, workers=workers):
+        # the archive and its temp files may live under dirpath, they are not subject to retention
+        if archive_name is not None and entry.name.startswith(archive_name) and os.path.abspath(entry.path).startswith(archive_abspath):
+            continue
+        stat = entry.stat()
+        entries.append((stat.st_mtime, stat.st_size, Path(entry.path)))
+    # newest first, the policies keep from the top
+    entries.sort(key=lambda item: item[0], reverse=True)
+
+    cutoff = time.time() - max_age_days * 86400 if max_age_days is not None else None
+    planned = []
+    kept_bytes = 0
+    cap_hit = False
+    for rank, (mtime, size, path) in enumerate(entries):
+        expired = (cutoff is not None and mtime < cutoff) or (keep_newest is not None and rank >= keep_newest)
+        if not expired and max_total_bytes is not None:
+            # once a file doesn't fit, every older file goes too
+            cap_hit = cap_hit or kept_bytes + size > max_total_bytes
+            expired = cap_hit
+        if expired:
+            planned.append((path, size))
+        else:
+            kept_bytes += size
+
+    report = {
+        "planned": [path for path, _ in planned],
+        "deleted": [],
+        "failed": [],
+        "bytes_freed": 0,
+        "scanned": len(entries),
+        "kept": len(entries) - len(planned),
+        "dry_run": dry_run,
+        "archive": None,
+    }
+    if dry_run or not planned:
+        return report
+
+    if archive_path is not None:
+        base = Path(dirpath)
+        # add to a copy of the archive so earlier runs' files survive a failed run
+        temp_path = Path(f"{archive_path}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            if os.path.exists(archive_path):
+                shutil.copyfile(archive_path, temp_path)
+            with ZipFile(temp_path, "a", ZIP_DEFLATED) as zf:
+                _write_members(zf, ((path, path.relative_to(base)) for path, _ in planned), workers)
+            os.replace(temp_path, archive_path)
+        except BaseException:
+            if temp_path.exists():
+                os.remove(temp_path)
+            raise
+        report["archive"] = Path(archive_path)
+
+    def remove(item: Tuple[Path, int]) -> Optional[str]:
+        try:
+            os.remove(item[0])
+        except OSError as e:
+            return str(e)
+        return None
+
+    if workers is None or workers <= 1:
+        errors = list(map(remove, planned))
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            errors = list(executor.map(remove, planned))
+
+    for (path, size), error in zip(planned, errors):
+        if error is None:
+            report["deleted"].append(path)
+            report["bytes_freed"] += size
+        else:
+            report["failed"].append((path, error))
+    return report
+
+
+def fingerprint_tree(dirpath: PathLike, extensions: Union[str, Sequence[str]] = None, pattern: str = None, recursive=True, workers: int = None, cache_path: PathLike = None, algorithm="sha256") -> Dict[Path, str]:
+    """
+    Returns the content hash of every file under a directory. Files are hashed
+    in a thread pool with large buffered reads. With a cache_path, hashes are
+    kept in a cache file keyed by (device, inode, size, mtime_ns), so
+    fingerprinting an unchanged tree again only costs the directory scan.
+
+    Args:
+        dirpath: The directory to scan
+        extensions (optional): Only hash files with this extension or extensions
+        pattern (str, optional): Only hash files whose name matches this glob pattern
+        recursive (bool, optional): Whether to scan subdirectories. Defaults to True.
+        workers (int, optional): Number of threads hashing files. Defaults to None.
+        cache_path (optional): Path of the fingerprint cache file, created if missing
+        algorithm (str, optional): hashlib algorithm name. Defaults to "sha256".
+
+    Returns:
+        Dictionary of file path to hex digest
+    """
+    entries = list(iter_files(dirpath, extensions, pattern=pattern, max_depth=None if recursive else 0, workers=workers))
+    return _fingerprint_entries(entries, workers, cache_path, algorithm)
+
+
+def find_duplicate_files(dirpath: PathLike, extensions: Union[str, Sequence[str]] = None, pattern: str = None, recursive=True, workers: int = None, cache_path: PathLike = None, algorithm="sha256") -> List[List[Path]]:
+    """
+    Finds groups of files with identical contents under a directory. Only
+    files sharing a size are looked at, and only those which also share a
+    hash of their first 64 KB are fully hashed. Empty files are ignored.
+
+    Args:
+        dirpath: The directory to scan
+        extensions, pattern, recursive, workers, cache_path, algorithm: See fingerprint_tree
+
+    Returns:
+        List of groups, each a sorted list of two or more paths with the same contents
+    """
+    by_size = {}
+    for entry in iter_files(dirpath, extensions, pattern=pattern, max_depth=None if recursive else 0, workers=workers):
+        size = entry.stat().st_size
+        if size:
+            by_size.setdefault(size, []).append(entry)
+
+    candidates = [entries for entries in by_size.values() if len(entries) > 1]
+    small = [entry for entries in candidates for entry in entries if entry.stat().st_size <= _PARTIAL_HASH_SIZE]
+    large = [entry for entries in candidates for entry in entries if entry.stat().st_size > _PARTIAL_HASH_SIZE]
+
+    # a partial hash rules out most large files without reading them whole
+    partial_hashes = _map_in_threads(lambda entry: _hash_file(entry.path, algorithm, _PARTIAL_HASH_SIZE), large, workers)
+    by_partial = {}
+    for entry, digest in zip(large, partial_hashes):
+        by_partial.setdefault((entry.stat().st_size, digest), []).append(entry)
+    to_hash = small + [entry for entries in by_partial.values() if len(entries) > 1 for entry in entries]
+
+    fingerprints = _fingerprint_entries(to_hash, workers, cache_path, algorithm)
+    groups = {}
+    for entry in to_hash:
+        path = Path(entry.path)
+        groups.setdefault((entry.stat().st_size, fingerprints[path]), []).append(path)
+    return sorted(sorted(paths) for paths in groups.values() if len(paths) > 1)
+
+
+def _fingerprint_entries(entries: List[os.DirEntry], workers: int, cache_path: PathLike, algorithm: str) -> Dict[Path, str]:
+    cache = _load_fingerprint_cache(cache_path, algorithm) if cache_path is not None else {}
+    fingerprints = {}
+    missing = []
+    for entry in entries:
+        stat = entry.stat()
+        key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        digest = cache.get(key)
+        if digest is None:
+            missing.append((entry, key))
+        else:
+            fingerprints[Path(entry.path)] = digest
+
+    digests = _map_in_threads(lambda item: _hash_file(item[0].path, algorithm), missing, workers)
+    for (entry, key), digest in zip(missing, digests):
+        fingerprints[Path(entry.path)] = cache[key] = digest
+
+    if cache_path is not None and missing:
+        # drop the old keys of rescanned files which changed, so the cache doesn't grow with every edit
+        current = {key[:2]: key for _, key in missing}
+        cache = {key: digest for key, digest in cache.items() if current.get(key[:2], key) == key}
+        _save_fingerprint_cache(cache_path, algorithm, cache)
+    return fingerprints
+
+
+def _map_in_threads(func: Callable[[Any], Any], items: List[Any], workers: int) -> List[Any]:
+    if workers is None or workers <= 1:
+        return list(map(func, items))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(func, items))
+
+
+def _hash_file(path: PathLike, algorithm: str, limit: int = None) -> str:
+    """
+    Hashes a file, or only its first limit bytes, reading into one reused
+    buffer. hashlib releases the GIL on large updates, so threads scale.
+    """
+    digest = hashlib.new(algorithm)
+    buffer = bytearray(min(_HASH_BUFFER_SIZE, limit) if limit else _HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    remaining = limit
+    with open(path, "rb", buffering=0) as f:
+        while remaining is None or remaining > 0:
+            n = f.readinto(view if remaining is None else view[:min(len(buffer), remaining)])
+            if not n:
+                break
+            digest.update(view[:n])
+            if remaining is not None:
+                remaining -= n
+    return digest.hexdigest()
+
+
+def _load_fingerprint_cache(cache_path: PathLike, algorithm: str) -> Dict[tuple, str]:
+    # marshal rather than pickle, loading a cache file must not run code
+    try:
+        with open(cache_path, "rb") as f:
+            cache = marshal.load(f)
+    except Exception:
+        # unreadable or foreign files just mean starting over
+        return {}
+    if not isinstance(cache, dict) or cache.get("algorithm") != algorithm or not isinstance(cache.get("entries"), dict):
+        return {}
+    return cache["entries"]
+
+
+def _save_fingerprint_cache(cache_path: PathLike, algorithm: str, entries: Dict[tuple, str]) -> None:
+    temp_path = Path(str(cache_path) + f".{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(temp_path, "wb") as f:
+        marshal.dump({"algorithm": algorithm, "entries": entries}, f)
+    os.replace(temp_path, cache_path)
+
+
+class DirSnapshot:
+    """
+    Compact state of a directory tree: the relative path, size and mtime
+    (in ns) of every file, plus its content hash when taken with fingerprints.
+    Sizes and mtimes are kept in typed arrays, so a snapshot of a million
+    files stays small and saves quickly. Create one with take_snapshot.
+
+    Args:
+        root: The directory the paths are relative to
+        paths: Relative file paths, sorted
+        sizes: File sizes in bytes
+        mtimes: Modification times in nanoseconds
+        fingerprints (optional): Hex digests of the files, in the same order
+    """
+
+    __slots__ = ("root", "paths", "sizes", "mtimes", "fingerprints")
+
+    def __init__(self, root: PathLike, paths: List[str], sizes: Iterable[int], mtimes: Iterable[int], fingerprints: List[str] = None):
+        self.root = Path(root)
+        self.paths = paths
+        self.sizes = array("q", sizes)
+        self.mtimes = array("q", mtimes)
+        self.fingerprints = fingerprints
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def save(self, snapshot_path: PathLike) -> Path:
+        """
+        Writes the snapshot to a file, atomically replacing an older one.
+
+        Returns:
+            Path to the snapshot file
+        """
+        state = {
+            "version": _SNAPSHOT_VERSION,
+            "root": str(self.root),
+            "paths": self.paths,
+            "sizes": self.sizes.tobytes(),
+            "mtimes": self.mtimes.tobytes(),
+            "fingerprints": self.fingerprints,
+        }
+        temp_path = Path(str(snapshot_path) + f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(temp_path, "wb") as f:
+            marshal.dump(state, f)
+        os.replace(temp_path, snapshot_path)
+        return Path(snapshot_path)
+
+    @classmethod
+    def load(cls, snapshot_path: PathLike) -> "DirSnapshot":
+        """
+        Reads a snapshot written by save. The file is read with marshal, so
+        loading one never runs code.
+
+        Raises:
+            ValueError: The file is not a snapshot written by save
+        """
+        with open(snapshot_path, "rb") as f:
+            try:
+                state = marshal.load(f)
+            except (EOFError, TypeError, ValueError):
+                state = None
+        if not isinstance(state, dict) or state.get("version") != _SNAPSHOT_VERSION:
+            raise ValueError(f"{snapshot_path} is not a directory snapshot")
+        snapshot = cls(state["root"], state["paths"], (), (), state["fingerprints"])
+        snapshot.sizes.frombytes(state["sizes"])
+        snapshot.mtimes.frombytes(state["mtimes"])
+        if not len(snapshot.paths) == len(snapshot.sizes) == len(snapshot.mtimes):
+            raise ValueError(f"{snapshot_path} is not a directory snapshot")
+        return snapshot
+
+
+def take_snapshot(dirpath: PathLike, extensions: Union[str, Sequence[str]] = None, pattern: str = None, fingerprints=False, workers: int = None, cache_path: PathLike = None, algorithm="sha256") -> DirSnapshot:
+    """
+    Records the files under a directory, recursively, with one stat per file.
+
+    Example:
+        Only zipping what changed since the last run::
+
+            >>> old = DirSnapshot.load("reports.snapshot")
+            >>> new = take_snapshot("reports")
+            >>> zipfiles("changed.zip", diff_snapshots(old, new)["modified"])
+            >>> new.save("reports.snapshot")
+
+    Args:
+        dirpath: The directory to snapshot
+        extensions (optional): Only record files with this extension or extensions
+        pattern (str, optional): Only record files whose name matches this glob pattern
+        fingerprints (bool, optional): Whether to hash the file contents too, so
+            diffs ignore files which were only touched. Defaults to False.
+        workers (int, optional): Number of threads scanning and hashing. Defaults to None.
+        cache_path (optional): Fingerprint cache file, see fingerprint_tree
+        algorithm (str, optional): hashlib algorithm for fingerprints. Defaults to "sha256".
+
+    Returns:
+        DirSnapshot of the directory
+    """
+    root = os.path.join(os.fspath(dirpath), "")
+    entries = sorted(iter_files(dirpath, extensions, pattern=pattern, workers=workers), key=lambda entry: entry.path)
+    paths = [entry.path[len(root):] for entry in entries]
+    stats = [entry.stat() for entry in entries]
+    digests = None
+    if fingerprints:
+        by_path = _fingerprint_entries(entries, workers, cache_path, algorithm)
+        digests = [by_path[Path(entry.path)] for entry in entries]
+    return DirSnapshot(dirpath, paths, (stat.st_size for stat in stats), (stat.st_mtime_ns for stat in stats), digests)
+
+
+def diff_snapshots(old: DirSnapshot, new: DirSnapshot) -> Dict[str, List[Path]]:
+    """
+    Compares two snapshots in a single pass over each. A file is modified when
+    its fingerprint changed, or, unless both snapshots have fingerprints, when
+    its size or mtime changed.
+
+    Returns:
+        Dictionary with sorted "added" and "modified" paths under new.root and
+        "removed" paths under old.root
+    """
+    old_positions = {path: i for i, path in enumerate(old.paths)}
+    compare_contents = old.fingerprints is not None and new.fingerprints is not None
+    added, modified = [], []
+    for j, path in enumerate(new.paths):
+        i = old_positions.pop(path, None)
+        if i is None:
+            added.append(new.root / path)
+        elif compare_contents:
+            if old.fingerprints[i] != new.fingerprints[j]:
+                modified.append(new.root / path)
+        elif old.sizes[i] != new.sizes[j] or old.mtimes[i] != new.mtimes[j]:
+            modified.append(new.root / path)
+    removed = [old.root / path for path in sorted(old_positions)]
+    return {"added": sorted(added), "removed": removed, "modified": sorted(modified)}
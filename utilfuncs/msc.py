@@ -1,7 +1,12 @@
+import asyncio
 import datetime
+import fnmatch
+import functools
+import random
+import re
 import time
 from types import FunctionType
-from typing import Any, Callable, Sequence
+from typing import Any, Callable, Dict, List, Pattern, Sequence, Tuple, Type, Union
 
 
 def get_timestamp(date_only=False):
@@ -24,7 +29,7 @@ def keep_retrying_on_specific_error(error_substr: str, sleep_seconds: int, func:
     raised containing the error_substr.
     Sleeps for the specified number of seconds between each call.
     If an error occurs and the error_substr is not part of the error message, it
-    is allowed to raise.
+    is allowed to raise. See RetryPolicy for backoff, limits and async support.
 
     Args:
         error_substr: Specific error string on which to retry 
@@ -34,14 +39,146 @@ def keep_retrying_on_specific_error(error_substr: str, sleep_seconds: int, func:
     Returns:
         Whatever the provided function ought to return.
     """
-    while True:
-        try:
-            return func(*args, **kwargs)
-        except Exception as e:
-            if is_substr(str(e), error_substr, ignorecase=True):
-                time.sleep(sleep_seconds)
+    policy = RetryPolicy(match=error_substr, initial_delay=sleep_seconds, backoff=1, max_delay=sleep_seconds, jitter=0)
+    return policy.call(func, *args, **kwargs)
+
+
+class RetryPolicy:
+    """
+    Retries a function while it raises matching errors, sleeping with
+    exponential backoff and jitter between attempts. Works for plain functions,
+    coroutines and as a decorator for either.
+
+    Example:
+        Retrying a flaky request at most 5 times within 30 seconds::
+
+            >>> policy = RetryPolicy(exceptions=ConnectionError, match=["timed out", re.compile(r"HTTP 5\\d\\d")], max_attempts=5, deadline=30)
+            >>> response = policy.call(fetch, url)
+            >>> response, stats = await policy.call_async_with_stats(async_fetch, url)
+            >>> @policy
+            ... def fetch(url): ...
+
+    Args:
+        exceptions (optional): Exception type or tuple of types to retry on. Defaults to Exception.
+        match (optional): Substring or compiled regex, or a sequence of them, one of
+            which the error message must contain. Substrings ignore case.
+            Defaults to None, any message.
+        max_attempts (int, optional): Total number of calls before the error is
+            raised. Defaults to None, no limit.
+        deadline (float, optional): Seconds after the first call past which no
+            retry is started. Defaults to None, no limit.
+        initial_delay (float, optional): Seconds to sleep after the first failure. Defaults to 1.0.
+        backoff (float, optional): Factor the delay grows by after each failure. Defaults to 2.0.
+        max_delay (float, optional): Upper bound of a single delay. Defaults to 60.0.
+        jitter (float, optional): Fraction of each delay, 0 to 1, which is randomly
+            taken off so callers don't retry in lockstep. Defaults to 0.5.
+    """
+
+    def __init__(self, exceptions: Union[Type[BaseException], Tuple[Type[BaseException], ...]] = Exception, match: Union[str, Pattern, Sequence[Union[str, Pattern]]] = None, max_attempts: int = None, deadline: float = None, initial_delay: float = 1.0, backoff: float = 2.0, max_delay: float = 60.0, jitter: float = 0.5):
+        if isinstance(match, (str, re.Pattern)):
+            match = [match]
+        self.exceptions = exceptions
+        self.substrings = [m.lower() for m in match or () if isinstance(m, str)]
+        self.regexes = [m for m in match or () if not isinstance(m, str)]
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.initial_delay = initial_delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def __call__(self, func: Callable) -> Callable:
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                return await self.call_async(func, *args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.call(func, *args, **kwargs)
+        return wrapper
+
+    def call(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        Calls func with args and kwargs, retrying on matching errors.
+
+        Returns:
+            Whatever func returns
+        """
+        return self.call_with_stats(func, *args, **kwargs)[0]
+
+    def call_with_stats(self, func: Callable, *args, **kwargs) -> Tuple[Any, Dict[str, Any]]:
+        """
+        Like call, but also returns a dictionary with the number of "attempts",
+        the seconds "slept" and the seconds "elapsed" overall.
+        """
+        started = time.monotonic()
+        attempts, slept = 0, 0
+        while True:
+            attempts += 1
+            try:
+                result = func(*args, **kwargs)
+            except self.exceptions as e:
+                delay = self._delay_before_retry(e, attempts, started)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                slept += delay
+            else:
+                return result, {"attempts": attempts, "slept": slept, "elapsed": time.monotonic() - started}
+
+    async def call_async(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        Awaits the coroutine function func, retrying on matching errors with
+        asyncio.sleep so the event loop keeps running.
+
+        Returns:
+            Whatever func returns
+        """
+        return (await self.call_async_with_stats(func, *args, **kwargs))[0]
+
+    async def call_async_with_stats(self, func: Callable, *args, **kwargs) -> Tuple[Any, Dict[str, Any]]:
+        """
+        Like call_async, but also returns the stats described in call_with_stats.
+        """
+        started = time.monotonic()
+        attempts, slept = 0, 0
+        while True:
+            attempts += 1
+            try:
+                result = await func(*args, **kwargs)
+            except self.exceptions as e:
+                delay = self._delay_before_retry(e, attempts, started)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                slept += delay
             else:
-                raise
+                return result, {"attempts": attempts, "slept": slept, "elapsed": time.monotonic() - started}
+
+    def _delay_before_retry(self, error: BaseException, attempts: int, started: float):
+        """
+        Returns the seconds to sleep before the next attempt, or None when
+        the error should be raised.
+        """
+        if not self._matches(error):
+            return None
+        if self.max_attempts is not None and attempts >= self.max_attempts:
+            return None
+        delay = min(self.initial_delay * self.backoff ** (attempts - 1), self.max_delay)
+        if self.jitter:
+            delay *= 1 - self.jitter * random.random()
+        if self.deadline is not None and time.monotonic() + delay - started > self.deadline:
+            return None
+        return delay
+
+    def _matches(self, error: BaseException) -> bool:
+        if not self.substrings and not self.regexes:
+            return True
+        message = str(error)
+        lowered = message.lower()
+        return any(substr in lowered for substr in self.substrings) or any(regex.search(message) for regex in self.regexes)
 
 
 def is_substr(string: str, substr: str, ignorecase=False) -> bool:
@@ -63,26 +200,107 @@ def is_substr(string: str, substr: str, ignorecase=False) -> bool:
         return substr in string
 
 
-def filter_by_glob(collection: Sequence[Any], pattern: str) -> Sequence[Any]:
+def filter_by_glob(collection: Sequence[Any], pattern: Union[str, Sequence[str]], ignorecase=False) -> Sequence[Any]:
     """
     Returns a filtered collection based on which
     items match the provided string pattern.
 
     Args:
         collection: Sequence to filter on
-        pattern: String, optionally containing a wildcard '*' character
+        pattern: Glob pattern supporting '*', '?' and '[...]', or a sequence of
+            patterns of which any may match
+        ignorecase (bool, optional): Whether to ignore case. Defaults to False.
 
     Returns:
         Subset of items in the collection that match the glob pattern
     """
-    parts = pattern.split("*")
-    beginning = parts[0]
-    ending = parts[1]
+    patterns = (pattern,) if isinstance(pattern, str) else tuple(pattern)
+    return _cached_glob_matcher(patterns, ignorecase).filter(collection)
+
+
+class GlobMatcher:
+    """
+    Matches strings against many glob patterns at once. Patterns without
+    wildcards are looked up in a set, plain "prefix*" and "*suffix" patterns
+    are checked with one startswith or endswith call each, and all others are
+    combined into a single compiled regex. Items are compared by their str().
+
+    Example:
+        Keeping source and config files::
+
+            >>> matcher = GlobMatcher(["*.py", "setup.cfg", "requirements*.txt"])
+            >>> matcher.filter(["app.py", "setup.cfg", "README.md"])
+            ['app.py', 'setup.cfg']
+
+    Args:
+        patterns: Glob pattern or sequence of patterns supporting '*', '?' and '[...]'
+        ignorecase (bool, optional): Whether to ignore case. Defaults to False.
+    """
+
+    def __init__(self, patterns: Union[str, Sequence[str]], ignorecase=False):
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        self.patterns = list(patterns)
+        self.ignorecase = ignorecase
+        literals, prefixes, suffixes, wildcards = set(), [], [], []
+        for pattern in self.patterns:
+            if ignorecase:
+                pattern = pattern.lower()
+            if not any(c in pattern for c in "*?["):
+                literals.add(pattern)
+            elif pattern.count("*") == 1 and pattern.endswith("*") and not any(c in pattern for c in "?["):
+                prefixes.append(pattern[:-1])
+            elif pattern.count("*") == 1 and pattern.startswith("*") and not any(c in pattern for c in "?["):
+                suffixes.append(pattern[1:])
+            else:
+                wildcards.append(fnmatch.translate(pattern))
+        self._literals = literals
+        self._prefixes = tuple(prefixes)
+        self._suffixes = tuple(suffixes)
+        self._regex = re.compile("|".join(wildcards)) if wildcards else None
+        self._match_key = self._build_key_matcher()
+
+    def matches(self, item: Any) -> bool:
+        """
+        Returns whether the str() of item matches any of the patterns.
+        """
+        key = str(item)
+        return bool(self._match_key(key.lower() if self.ignorecase else key))
+
+    def filter(self, collection: Sequence[Any]) -> List[Any]:
+        """
+        Returns the items of collection matching any of the patterns, in order.
+        """
+        items = collection if isinstance(collection, (list, tuple)) else list(collection)
+        keys = map(str, items)
+        if self.ignorecase:
+            keys = map(str.lower, keys)
+        match_key = self._match_key
+        return [item for item, key in zip(items, keys) if match_key(key)]
+
+    def _build_key_matcher(self) -> Callable[[str], Any]:
+        """
+        Returns the cheapest function testing a str against all patterns, so
+        common single-kind pattern sets avoid any Python-level dispatch.
+        """
+        literals, prefixes, suffixes, regex = self._literals, self._prefixes, self._suffixes, self._regex
+        if not (prefixes or suffixes):
+            if not literals:
+                return regex.match if regex is not None else (lambda key: False)
+            if regex is None:
+                return literals.__contains__
+        if not (literals or suffixes or regex):
+            return lambda key: key.startswith(prefixes)
+        if not (literals or prefixes or regex):
+            return lambda key: key.endswith(suffixes)
+
+        def match_key(key: str) -> bool:
+            if key in literals or key.startswith(prefixes) or key.endswith(suffixes):
+                return True
+            return regex is not None and regex.match(key) is not None
+        return match_key
 
-    new_list = []
 
-    for item in collection:
-        item_as_str = str(item)
-        if item_as_str.startswith(beginning) and item_as_str.endswith(ending):
-            new_list.append(item)
-    return new_list
\ No newline at end of file
+@functools.lru_cache(maxsize=128)
+def _cached_glob_matcher(patterns: Tuple[str, ...], ignorecase: bool) -> GlobMatcher:
+    return GlobMatcher(patterns, ignorecase)